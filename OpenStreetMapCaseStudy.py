@@ -5,11 +5,28 @@
 import xml.etree.ElementTree as ET  
 import pprint
 import re
-from collections import defaultdict
-import cerberus
-import codecs
+from collections import defaultdict, Counter
 import csv
-import sqlite3
+import operator
+import os
+import time
+import json
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+import Queue
+import cStringIO
+import traceback
+import unicodedata
+import hashlib
+import cPickle
+import argparse
+import tempfile
+import shutil
+import bisect
+import struct
+import math
+from array import array
 
 # ================================================== #
 #      Creating a sample file and viewing data       #
@@ -34,46 +51,47 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
             yield elem
             root.clear()
 
-''' The following code uses the get_element function, as well as the parameter k, to create a sample 1/kth the size of the original '''
+def make_sample(osm_file=OSM_FILE, sample_file=SAMPLE_FILE, k=k):
+    ''' Uses the get_element function, as well as the parameter k, to create a sample 1/kth the size of the original '''
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+    with open(sample_file, 'wb') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
-    output.write('</osm>')
+        # Write every kth top level element
+        for i, element in enumerate(get_element(osm_file)):
+            if i % k == 0:
+                output.write(ET.tostring(element, encoding='utf-8'))
+        output.write('</osm>')
 
 
-''' The following code prints the first 10 elements of the osm file '''
+def print_first_elements(filename, n=10):
+    ''' Prints the first elements of an osm file, stopping after element n '''
+    for i, element in enumerate(get_element(filename)):
+        print(ET.tostring(element, encoding='utf-8'))
+        if i == n:
+            break
 
-print "First ten elements of the sample file:"
-for i, element in enumerate(get_element('sample.osm')):
-    print(ET.tostring(element, encoding='utf-8'))
-    if i == 10:
-        break
 
-'''The following code creates a dictionary of dictionaries of the secondary tags found in a node and prints it'''
- if the value is not an empty dictionary 
+def print_node_tags(filename):
+    '''Creates a dictionary of dictionaries of the secondary tags found in a node and prints it
+    if the value is not an empty dictionary'''
 
-tree = ET.parse('sample.osm')
-root = tree.getroot()
-nodecount = 0
-node_dict = {}
-for node in root.findall('node'):
-    node_dict[nodecount] = {}
-    tagcount = 0
-    for tag in node.findall('tag'):
-        node_dict[nodecount][tagcount] = tag.attrib['k'] + ":" + (tag.attrib['v'])
-        tagcount +=1
-    nodecount += 1
+    tree = ET.parse(filename)
+    root = tree.getroot()
+    nodecount = 0
+    node_dict = {}
+    for node in root.findall('node'):
+        node_dict[nodecount] = {}
+        tagcount = 0
+        for tag in node.findall('tag'):
+            node_dict[nodecount][tagcount] = tag.attrib['k'] + ":" + (tag.attrib['v'])
+            tagcount +=1
+        nodecount += 1
 
-print "Node tags:"
-for i in node_dict:
-    if bool(node_dict[i]):
-        pprint.pprint(node_dict[i])
+    for i in node_dict:
+        if bool(node_dict[i]):
+            pprint.pprint(node_dict[i])
 
 
 
@@ -105,6 +123,49 @@ lower = re.compile(r'^([a-z]|_)*$')
 lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
 problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
+KEY_TYPES = ("lower", "lower_colon", "problemchars", "other")
+
+def classify_key(key):
+    ''' Returns the type of a tag key: "lower", "lower_colon", "problemchars" or "other" '''
+    if lower.search(key):
+        return "lower"
+    elif lower_colon.search(key):
+        return "lower_colon"
+    elif problemchars.search(key):
+        return "problemchars"
+    else:
+        return "other"
+
+class KeyClassifier(object):
+    """Classify tag keys with classify_key, remembering the type of every key seen
+
+    Keys come from a small vocabulary repeated across the whole file, so after the first
+    few thousand elements nearly every key is a dictionary lookup instead of regex searches.
+    """
+
+    def __init__(self):
+        self.cache = {}
+
+    def classify(self, key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            key_class = self.cache[key] = classify_key(key)
+            return key_class
+
+    def classify_keys(self, keys):
+        '''
+        Classifies a batch of keys, each distinct key once
+        Returns:
+            counts: a dictionary of the number of keys of each type
+        '''
+        counts = dict.fromkeys(KEY_TYPES, 0)
+        for key, n in Counter(keys).iteritems():
+            counts[self.classify(key)] += n
+        return counts
+
+key_classifier = KeyClassifier()
+
 def key_type(element, keys):
     """
     Determines the type of tag present in an element    
@@ -115,15 +176,7 @@ def key_type(element, keys):
                    keys: an updated version of the argument
     """
     if element.tag == "tag":
-        attr = element.attrib['k']
-        if lower.search(attr):
-            keys["lower"] += 1
-        elif lower_colon.search(attr):
-            keys["lower_colon"] += 1
-        elif problemchars.search(attr):
-            keys["problemchars"] +=1
-        else:
-            keys["other"] += 1
+        keys[key_classifier.classify(element.attrib['k'])] += 1
     return keys
 
 
@@ -131,15 +184,12 @@ def tagkeycount(filename):
     """
     Determines the type of tag present in an element    
          Args:
-                element: an element of an XML file
-                keys: a dictionary where key values are the type of key, and the count is the value 
+                filename: an XML file
          Returns:
-                keys: an updated version of the argument
+                keys: a dictionary where key values are the type of key, and the count is the value
     """
-    keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
-    return keys
+    return key_classifier.classify_keys(element.attrib['k'] for _, element in ET.iterparse(filename)
+                                        if element.tag == "tag")
 
 def probchars(filename):
     """
@@ -153,10 +203,31 @@ def probchars(filename):
     for _, element in ET.iterparse(filename):
         if element.tag == "tag":
             attr = element.attrib['k']
-            if problemchars.search(attr):
+            if key_classifier.classify(attr) == "problemchars":
                 prob_tags[element] = attr, element.attrib['v']
     return prob_tags
 
+def benchmark_key_classifier(filename, n=1000000):
+    '''
+    Classifies n tag keys, repeating the keys of filename in their original proportions,
+    once by running classify_key on each and once with a fresh KeyClassifier,
+    and prints the keys/second of each
+    '''
+    keys = [element.attrib['k'] for _, element in ET.iterparse(filename) if element.tag == "tag"]
+    keys = (keys * (n // len(keys) + 1))[:n]
+
+    start = time.time()
+    counts = dict.fromkeys(KEY_TYPES, 0)
+    for key in keys:
+        counts[classify_key(key)] += 1
+    elapsed = time.time() - start
+    print "classify_key: {0:.0f} keys/second".format(n / elapsed)
+
+    start = time.time()
+    KeyClassifier().classify_keys(keys)
+    elapsed = time.time() - start
+    print "KeyClassifier.classify_keys: {0:.0f} keys/second".format(n / elapsed)
+
 def tagkeys(filename):
     """
     Counts the various key attributes found in tags of an xml file
@@ -271,86 +342,206 @@ def number_users(filename):
                 users.add(get_user(element))
     return users
 
-users = number_users('santiago.osm')
-print "There are {0} unique users contributing to this data set.".format(len(users))
-
-tags = count_tags('sample.osm')
-print "Tags present"
-pprint.pprint(tags)
-
-keys = tagkeycount('sample.osm')
-print "Types of tags present:"
-pprint.pprint(keys)
-
-print "Problematic tags:"
-pprint.pprint(probchars('sample.osm'))
-
-tag_key_values = tagkeys('sample.osm')
-print "Tag Keys:"
-dict_print_by_value(tag_key_values)
-
-print "Addr:housenumber values which are not integers:"
-pprint.pprint(house_numbers('sample.osm'))
-print "There are {0} total house numbers which are not integers.".format(len(house_numbers('sample.osm')))
-
-street_values = streets('sample.osm')
-print "Streets:"
-pprint.pprint(street_values)
-
-'''Prints street names with "."'''
-streetcount = 0
-for street in street_values:
-    if street.find('.')!=-1:
-        streetcount +=1
-        print street #.decode('utf-8') 
-
-print "There are {0} streets with the '.' character in them.".format(streetcount)
-
-print "Name values:"
-dict_print_by_value(tagfinder('sample.osm', 'name'))
-print "Addr:interpolation values:"
-dict_print_by_value(tagfinder('sample.osm', 'addr:interpolation'))
-print "Highway values:"
-dict_print_by_value(tagfinder('sample.osm', 'highway'))
-print "Source values:"
-dict_print_by_value(tagfinder('sample.osm', 'source'))
-print "Id_origin values:"
-dict_print_by_value(tagfinder('sample.osm', 'id_origin'))
-
-'''Creates a dictionary of nodes, each node has a list of the secondary tags assigned to it'''
-
-tag_list={}
-nodecount=0
-for node in root.findall('node'):
-    tag_list[nodecount] = []
-    for tag in node.findall('tag'):
-        tag_list[nodecount].append(tag.attrib['k'])
-    nodecount += 1
-
-'''Counts the number of nodes which have both an amenity and name tag and nodes that have only an amenity tag with no name,
-same for street names and regular name tags '''
-
-ns_count =0
-na_count = 0
-amenity_only = 0
-street_only =0
-
-for node in tag_list:
-    if ('name' in tag_list[node]):
-        if ('amenity' in tag_list[node]):
-            na_count +=1
-        if ('addr:street' in tag_list[node]):
-            ns_count +=1
-    elif ('amenity' in tag_list[node]):
-        amenity_only +=1
-    elif ('addr:street' in tag_list[node]):
-        street_only +=1
-        
-print "Nodes with both amenity and name tags: " + str(na_count)
-print "Nodes with with an amenity but no name tag: " + str(amenity_only)
-print
-print "Nodes with both addr:street and name tags: " + str(ns_count)
-print "Nodes with with street but no name tag: " + str(street_only)
+def name_tag_counts(filename):
+    '''
+    Counts the nodes which have both an amenity and name tag and nodes that have only an amenity tag with no name,
+    same for street names and regular name tags
+    Returns:
+        counts: a dictionary with the number of nodes in each of those cases
+    '''
+    counts = dict.fromkeys(['name_amenity', 'name_street', 'amenity_only', 'street_only'], 0)
+    for _, element in ET.iterparse(filename):
+        if element.tag == 'node':
+            tag_list = [tag.attrib['k'] for tag in element.findall('tag')]
+            if ('name' in tag_list):
+                if ('amenity' in tag_list):
+                    counts['name_amenity'] += 1
+                if ('addr:street' in tag_list):
+                    counts['name_street'] += 1
+            elif ('amenity' in tag_list):
+                counts['amenity_only'] += 1
+            elif ('addr:street' in tag_list):
+                counts['street_only'] += 1
+            element.clear()
+    return counts
+
+# ================================================== #
+#               Caching audit results                #
+# ================================================== #
+
+AUDIT_CACHE_DIR = "audit_cache"
+FINGERPRINTS_PATH = os.path.join(AUDIT_CACHE_DIR, "fingerprints.json")
+
+
+def write_json(path, data):
+    ''' Writes data to path as JSON, replacing any existing file in one step '''
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+def file_fingerprint(filename):
+    '''
+    Returns the sha1 of a file's contents
+    The hash is stored along with the file's size and mtime, and reused while those are
+    unchanged, so an unchanged file is not read again
+    '''
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+    fingerprints = {}
+    if os.path.exists(FINGERPRINTS_PATH):
+        with open(FINGERPRINTS_PATH, 'rb') as f:
+            fingerprints = json.load(f)
+    known = fingerprints.get(path)
+    if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+        return str(known['sha1'])
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            sha1.update(block)
+    fingerprints[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+    if not os.path.isdir(AUDIT_CACHE_DIR):
+        os.makedirs(AUDIT_CACHE_DIR)
+    write_json(FINGERPRINTS_PATH, fingerprints)
+    return fingerprints[path]['sha1']
+
+def rules_fingerprint():
+    ''' Returns a hash of the rule config the audits depend on: the key type and number regexes '''
+    rules = [lower.pattern, lower_colon.pattern, problemchars.pattern, numbers.pattern]
+    return hashlib.sha1(repr(rules)).hexdigest()
+
+def code_fingerprint(function, seen=None):
+    '''
+    Returns a hash of a function's code: its bytecode, constants and names, those of any
+    code nested in it such as generator expressions, and, for each module level name it
+    uses, the code of that function or class's methods, the pattern of that regex or the
+    value of that constant, so that editing a literal or a helper changes the hash
+    '''
+    if seen is None:
+        seen = set()
+    parts = []
+
+    def add_code(code):
+        parts.append((code.co_code, code.co_names))
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                add_code(const)
+            else:
+                parts.append(repr(const))
+        for name in code.co_names:
+            if name in seen or name not in globals():
+                continue
+            seen.add(name)
+            value = globals()[name]
+            if isinstance(value, type) and value.__module__ == __name__:
+                value = dict(value.__dict__)
+            elif getattr(type(value), '__module__', None) == __name__:
+                value = dict(type(value).__dict__)
+            if isinstance(value, dict) and any(hasattr(v, '__code__') for v in value.values()):
+                for attr in sorted(value):
+                    if hasattr(value[attr], '__code__'):
+                        add_code(value[attr].__code__)
+            elif hasattr(value, '__code__') and value.__module__ == __name__:
+                add_code(value.__code__)
+            elif hasattr(value, 'pattern'):
+                parts.append(value.pattern)
+            elif isinstance(value, (basestring, int, float, tuple, list, set, frozenset, dict)):
+                parts.append(repr(value))
+
+    add_code(function.__code__)
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def cached_audit(audit, filename, *args):
+    '''
+    Returns audit(filename, *args), running the audit only if it has not already been run
+    with the same arguments, on the same file contents, with the same code and rules
+    The code is compared with code_fingerprint, which covers the helpers and constants the audit uses
+    Args:
+        audit: an auditing function taking a filename, e.g. tagfinder
+        filename: an OSM file
+        args: any further arguments to the audit, e.g. the tag for tagfinder
+    '''
+    key = hashlib.sha1(repr((audit.__name__, code_fingerprint(audit), args,
+                             file_fingerprint(filename), rules_fingerprint()))).hexdigest()
+    path = os.path.join(AUDIT_CACHE_DIR, "{0}-{1}.pickle".format(audit.__name__, key))
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return cPickle.load(f)
+
+    result = audit(filename, *args)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+    return result
+
+
+def audit(filename=SAMPLE_FILE, users_file=OSM_FILE):
+    '''
+    Runs the audits over an osm file and prints their results
+    Args:
+        filename: the osm file to audit, usually the sample
+        users_file: the osm file whose unique users are counted
+    '''
+    users = cached_audit(number_users, users_file)
+    print "There are {0} unique users contributing to this data set.".format(len(users))
+
+    tags = cached_audit(count_tags, filename)
+    print "Tags present"
+    pprint.pprint(tags)
+
+    keys = cached_audit(tagkeycount, filename)
+    print "Types of tags present:"
+    pprint.pprint(keys)
+
+    print "Problematic tags:"
+    pprint.pprint(cached_audit(probchars, filename))
+
+    tag_key_values = cached_audit(tagkeys, filename)
+    print "Tag Keys:"
+    dict_print_by_value(tag_key_values)
+
+    print "Addr:housenumber values which are not integers:"
+    pprint.pprint(cached_audit(house_numbers, filename))
+    print "There are {0} total house numbers which are not integers.".format(len(cached_audit(house_numbers, filename)))
+
+    street_values = cached_audit(streets, filename)
+    print "Streets:"
+    pprint.pprint(street_values)
+
+    # Prints street names with "."
+    streetcount = 0
+    for street in street_values:
+        if street.find('.')!=-1:
+            streetcount +=1
+            print street #.decode('utf-8')
+
+    print "There are {0} streets with the '.' character in them.".format(streetcount)
+
+    print "Name values:"
+    dict_print_by_value(cached_audit(tagfinder, filename, 'name'))
+    print "Addr:interpolation values:"
+    dict_print_by_value(cached_audit(tagfinder, filename, 'addr:interpolation'))
+    print "Highway values:"
+    dict_print_by_value(cached_audit(tagfinder, filename, 'highway'))
+    print "Source values:"
+    dict_print_by_value(cached_audit(tagfinder, filename, 'source'))
+    print "Id_origin values:"
+    dict_print_by_value(cached_audit(tagfinder, filename, 'id_origin'))
+
+    # Counts the number of nodes which have both an amenity and name tag and nodes that have only an amenity tag with no name,
+    # same for street names and regular name tags
+
+    counts = cached_audit(name_tag_counts, filename)
+    na_count, amenity_only = counts['name_amenity'], counts['amenity_only']
+    ns_count, street_only = counts['name_street'], counts['street_only']
+
+    print "Nodes with both amenity and name tags: " + str(na_count)
+    print "Nodes with with an amenity but no name tag: " + str(amenity_only)
+    print
+    print "Nodes with both addr:street and name tags: " + str(ns_count)
+    print "Nodes with with street but no name tag: " + str(street_only)
 
 
 # ================================================== #
@@ -384,7 +575,7 @@ sources= {'www.ine.cl' : 'Instituto Nacional de Estadistica www.ine.cl',
             'Instituto Nacional De Estadisticas': 'Instituto Nacional de Estadistica www.ine.cl',
             'Bing' : "Bing",
             "bing" : "Bing",
-            "2016 por KG" : "Reconocimiento cartográfico 2016 por KG"}
+            "2016 por KG" : u"Reconocimiento cartográfico 2016 por KG"}
 
 
 def update_streetname(name, mapping):
@@ -398,9 +589,21 @@ def update_sourcename(name, mapping):
     '''Changes a name from a key to a its value in a mapping dictionary'''
     for error in mapping.keys():
         if error in name:
-            name = ma
+            name = mapping[error]
+    return name
+
+street_classifiers = ["Av.", "Ave", "Avda.", "Avenida", "Calle", "Camino", "Diagonal",  "Pje", "Pje.", "Psje", "Pasaje"]
 
-streets = ["Av.", "Ave", "Avda.", "Avenida", "Calle", "Camino", "Diagonal",  "Pje", "Pje.", "Psje", "Pasaje"]
+'''street names found by the streets audit, used by name_street_fix; set with load_street_values'''
+street_values = {}
+
+'''whole street names and the names they are replaced with, e.g. from propose_street_overrides'''
+street_overrides = {}
+
+def load_street_values(filename):
+    ''' Sets the street names name_street_fix compares "name" values with to those found in an osm file '''
+    global street_values
+    street_values = cached_audit(streets, filename)
 
 def name_street_fix(element, street_values, street):
     ''' For "name" values: 
@@ -419,8 +622,8 @@ def name_street_fix(element, street_values, street):
             if element.attrib['v'] == street:
                     element.attrib['k'] = 'addr:street'
         # If the name value has a common street classifier in it, the tag key is changed to "addr:street"   
-        for street in streets:
-            if element.attrib['v'].find(street):
+        for street in street_classifiers:
+            if element.attrib['v'].find(street) != -1:
                 element.attrib['k'] = 'addr:street'
     return element
 
@@ -453,17 +656,263 @@ def Hualtatasfix(element):
     return element
 
           
-def fix(element):
-    ''' Runs all fix functions on an element '''
-    element = addressfix(element)
-    element = Hualtatasfix(element)
-    element = name_street_fix(element, street_values, street)
-    if elem.attrib['k'] == "addr:street":
-        element.attrib['v'] = update_streetname(element.attrib['v'], mapping)
+def streetname_fix(element):
+    ''' For "addr:street" values: replaces names in street_overrides, or expands abbreviations using the mapping dictionary '''
+    if element.attrib['k'] == "addr:street":
+        element.attrib['v'] = override_streetname(element.attrib['v'], street_overrides)
+    return element
+
+def override_streetname(name, overrides):
+    '''Changes a whole name to its value in an exact match overrides dictionary, or expands its abbreviations with mapping'''
+    if name in overrides:
+        return overrides[name]
+    return update_streetname(name, mapping)
+
+def sourcename_fix(element):
+    ''' For "source" values: replaces the value using the sources dictionary '''
     if element.attrib['k'] == 'source':
         element.attrib['v'] = update_sourcename(element.attrib['v'], sources)
     return element
 
+'''fix functions in the order fix runs them, with the names their changes are counted under,
+the tag keys each one may change and the keys it may leave in their place'''
+fix_rules = [('addressfix', addressfix, ['addr:housenumber'], ['name']),
+             ('Hualtatasfix', Hualtatasfix, ['addr:interpolation'], ['addr:name']),
+             ('name_street_fix', lambda element: name_street_fix(element, street_values, street_classifiers),
+              ['name'], ['addr:street']),
+             ('update_streetname', streetname_fix, ['addr:street'], ['addr:street']),
+             ('update_sourcename', sourcename_fix, ['source'], ['source'])]
+
+'''keys of the tags fix may change, and keys fixed tags may end up with'''
+fix_input_keys = set(key for _, _, keys, _ in fix_rules for key in keys)
+fix_output_keys = set(key for _, _, _, keys in fix_rules for key in keys)
+
+def fix(element, applied=None):
+    '''
+    Runs all fix functions on an element
+    If a list applied is given, the name of each fix which changed the element is appended to it
+    '''
+    for name, fix_function, _, _ in fix_rules:
+        before = element.attrib['k'], element.attrib['v']
+        element = fix_function(element)
+        if applied is not None and (element.attrib['k'], element.attrib['v']) != before:
+            applied.append(name)
+    return element
+
+
+# ================================================== #
+#            Street name deduplication               #
+# ================================================== #
+
+'''Street type words, as update_streetname spells them; names with two different street types are never grouped'''
+street_types = set(["avenida", "calle", "camino", "diagonal", "pasaje"])
+
+STREET_NUM_PERM = 16 # Parameter: MinHash values per street name
+STREET_BAND_SIZE = 2 # Parameter: MinHash values per LSH band; names sharing a band are compared
+STREET_BUCKET_LIMIT = 100 # Parameter: LSH buckets with more names than this are too common to compare
+STREET_SIMILARITY = 0.5 # Parameter: trigram Jaccard similarity at which two names are grouped
+
+# multiply-shift hash functions (odd multiplier, offset) for the MinHash permutations
+street_hash_seeds = [((2 * i + 1) * 0x9E3779B1 & 0xFFFFFFFF, i * 0x7F4A7C15 & 0xFFFFFFFF)
+                     for i in range(STREET_NUM_PERM)]
+non_word = re.compile(r'[^\w]+', re.UNICODE)
+
+
+def fold_accents(s):
+    ''' Returns a lower case unicode copy of s without accents, e.g. "Peñalolén" -> "penalolen" '''
+    if isinstance(s, str):
+        s = s.decode('utf-8')
+    s = unicodedata.normalize('NFKD', s)
+    return u''.join(c for c in s if not unicodedata.combining(c)).lower()
+
+def street_key(name, mapping=mapping):
+    '''
+    Blocking key for a street name: its street type, the first street type word after
+    update_streetname or u'' if it has none, and the sorted set of its other words
+    without accents or punctuation
+    e.g. "Av. Providencia" and "Avda Providencia" give (u"avenida", u"providencia"),
+    "Calle Providencia" gives (u"calle", u"providencia") and "Providencia" (u"", u"providencia")
+    '''
+    words = [word for word in non_word.split(fold_accents(update_streetname(name, mapping))) if word]
+    types = [word for word in words if word in street_types]
+    street_type = types[0] if types else u''
+    core = set(words) - set(types)
+    return street_type, u' '.join(sorted(core or words))
+
+def type_abbreviation(word):
+    '''
+    Returns the street type a word could abbreviate: a type it is shorter than, starting
+    with the same letter and with its letters in the same order, e.g. "avd" -> "avenida".
+    Returns None if no type, or more than one, fits
+    '''
+    if len(word) < 2:
+        return None
+    fits = []
+    for street_type in street_types:
+        letters = iter(street_type)
+        if len(word) < len(street_type) and word[0] == street_type[0] and all(c in letters for c in word):
+            fits.append(street_type)
+    return fits[0] if len(fits) == 1 else None
+
+def leading_abbreviation(name, mapping=mapping):
+    '''
+    For a name with no street type after update_streetname, returns its first word as
+    written (without a final "."), the street type that word could abbreviate and the
+    street_key core of the rest of the name; otherwise None
+    '''
+    expanded = update_streetname(name, mapping)
+    tokens = expanded.split()
+    if len(tokens) < 2 or street_key(name, mapping)[0]:
+        return None
+    token = tokens[0].rstrip('.')
+    street_type = type_abbreviation(fold_accents(token))
+    if street_type is None:
+        return None
+    return token, street_type, street_key(u' '.join(tokens[1:]), mapping)[1]
+
+def trigrams(key):
+    ''' Returns the set of character 3-grams of a key, padded so short keys have some '''
+    padded = u' ' + key + u' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def minhash(grams):
+    ''' Returns the MinHash signature of a set of strings as a tuple of STREET_NUM_PERM values '''
+    hashes = [hash(gram) & 0xFFFFFFFF for gram in grams]
+    return tuple(min([(a * h + b) & 0xFFFFFFFF for h in hashes]) for a, b in street_hash_seeds)
+
+
+def group_streets(street_counts, mapping=mapping, similarity=STREET_SIMILARITY):
+    '''
+    Groups street names which are probably the same street
+    Names with the same street_key are grouped straight away. Distinct keys are only
+    compared when their MinHash signatures share an LSH band, so the work grows about
+    linearly with the number of names rather than with the number of pairs. A name with no
+    street type can join a group of any one type, but a group never takes in two types, so
+    a Calle is never grouped with an Avenida of the same name. A name with no type whose
+    core words are those of names with two different types is left out, as ambiguous.
+    Args:
+        street_counts: a dictionary of street names and how many times they occur, as from streets()
+        mapping: the abbreviation mapping passed to update_streetname
+        similarity: the trigram Jaccard similarity at which two keys are grouped
+    Returns:
+        groups: a list of groups of two or more street names, most common name first
+    '''
+    names_by_key = defaultdict(list)
+    for name in street_counts:
+        names_by_key[street_key(name, mapping)].append(name)
+
+    keys = names_by_key.keys()
+    grams = [trigrams(core) for _, core in keys]
+    parent = range(len(keys))
+    # the street type of the names in each group, u'' until one with a type joins
+    group_type = [street_type for street_type, _ in keys]
+    types_by_core = defaultdict(set)
+    for street_type, core in keys:
+        if street_type:
+            types_by_core[core].add(street_type)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets = defaultdict(list)
+    for i, key_grams in enumerate(grams):
+        street_type, core = keys[i]
+        if not street_type and len(types_by_core[core]) > 1:
+            continue
+        signature = minhash(key_grams)
+        for band in range(0, STREET_NUM_PERM, STREET_BAND_SIZE):
+            buckets[(band, signature[band:band + STREET_BAND_SIZE])].append(i)
+
+    for bucket in buckets.itervalues():
+        if len(bucket) < 2 or len(bucket) > STREET_BUCKET_LIMIT:
+            continue
+        for n, i in enumerate(bucket):
+            for j in bucket[n + 1:]:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    type_i, type_j = group_type[root_i], group_type[root_j]
+                    if type_i and type_j and type_i != type_j:
+                        continue
+                    shared = len(grams[i] & grams[j])
+                    if shared >= similarity * (len(grams[i]) + len(grams[j]) - shared):
+                        parent[root_j] = root_i
+                        group_type[root_i] = type_i or type_j
+
+    grouped = defaultdict(list)
+    for i, key in enumerate(keys):
+        grouped[find(i)].extend(names_by_key[key])
+    return [sorted(names, key=lambda name: -street_counts[name])
+            for names in grouped.itervalues() if len(names) > 1]
+
+def propose_street_abbreviations(street_counts, mapping=mapping):
+    '''
+    Proposes mapping entries for street type abbreviations mapping does not know yet
+    A name's first word is taken as an abbreviation when it could abbreviate exactly one
+    street type (see type_abbreviation) and the rest of the name is also found with that
+    type written out, or after a different abbreviation of it,
+    e.g. "Avd. Providencia" and "Avenida Providencia" give {"Avd": "Avenida"}
+    Returns:
+        proposals: a dictionary of abbreviations and the street type they stand for
+    '''
+    types_by_core = defaultdict(set)
+    tokens_by_core = defaultdict(set)
+    candidates = []
+    for name in street_counts:
+        street_type, core = street_key(name, mapping)
+        if street_type:
+            types_by_core[core].add(street_type)
+            continue
+        candidate = leading_abbreviation(name, mapping)
+        if candidate:
+            token, street_type, core = candidate
+            tokens_by_core[(street_type, core)].add(token)
+            candidates.append(candidate)
+
+    proposals = {}
+    for token, street_type, core in candidates:
+        if street_type in types_by_core[core] or len(tokens_by_core[(street_type, core)]) > 1:
+            proposals[token] = street_type.capitalize()
+    return proposals
+
+def keeps_street_type(name, canonical, mapping=mapping):
+    ''' Returns False if changing name to canonical would drop or change its street type, written out or abbreviated '''
+    name_type = street_key(name, mapping)[0]
+    if not name_type:
+        abbreviation = leading_abbreviation(name, mapping)
+        name_type = abbreviation[1] if abbreviation else u''
+    return not name_type or name_type == street_key(canonical, mapping)[0]
+
+def propose_street_overrides(street_counts, mapping=mapping, similarity=STREET_SIMILARITY):
+    '''
+    Proposes street_overrides entries that would make each group from group_streets consistent
+    The abbreviations from propose_street_abbreviations are added to a copy of mapping first.
+    Every name in a group is mapped to the most common update_streetname form in the group
+    with a street type, if any has one, unless it already becomes that form. No name is
+    changed in a way that drops or changes its street type. The proposals are whole names,
+    to be matched exactly by override_streetname, and assume the abbreviations are added
+    to mapping too, e.g.
+        mapping.update(propose_street_abbreviations(cached_audit(streets, SAMPLE_FILE)))
+        street_overrides.update(propose_street_overrides(cached_audit(streets, SAMPLE_FILE)))
+    Returns:
+        proposals: a dictionary of street names and the name they should be changed to
+    '''
+    mapping = dict(mapping)
+    mapping.update(propose_street_abbreviations(street_counts, mapping))
+    proposals = {}
+    for names in group_streets(street_counts, mapping, similarity):
+        forms = defaultdict(int)
+        for name in names:
+            forms[update_streetname(name, mapping)] += street_counts[name]
+        typed = [form for form in forms if street_key(form, mapping)[0]]
+        canonical = max(typed or forms, key=lambda form: (forms[form], len(form)))
+        for name in names:
+            if update_streetname(name, mapping) != canonical and keeps_street_type(name, canonical, mapping):
+                proposals[name] = canonical
+    return proposals
+
 
 # ================================================== #
 #                  Schema for CSV files              #
@@ -546,9 +995,9 @@ WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
-PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 SCHEMA = schema
+KEY_CLASSIFIER = key_classifier
 
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
@@ -557,11 +1006,49 @@ WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
+STRING_POOL_SIZE = 1 << 20 # Parameter: most distinct strings kept by a string pool
+UNIQUE_ATTRIBS = ('id', 'lat', 'lon') # element attributes which are not worth interning
+
+
+class StringPool(dict):
+    """Hand out one shared copy of each string
+
+    Tag keys and values, user names and timestamps repeat across many elements. Interning
+    them keeps a single copy in memory for rows held in batches and lets pickle write a
+    repeated string once per batch. A pool is meant to last one batch, as in shape_worker;
+    process_map writes each element straight out, so it does not intern at all. Once
+    max_size strings are pooled, new ones are returned as they are.
+    """
+
+    def __init__(self, max_size=STRING_POOL_SIZE):
+        super(StringPool, self).__init__()
+        self.max_size = max_size
+
+    def intern(self, s):
+        try:
+            return self[s]
+        except KeyError:
+            if len(self) < self.max_size:
+                self[s] = s
+            return s
+
+def unpooled(s):
+    ''' Returns s, for shaping without a string pool '''
+    return s
+
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
+                  key_classifier=KEY_CLASSIFIER, default_tag_type='regular',
+                  string_pool=None, applied_fixes=None):
+    """Clean and shape node or way XML element to Python dict
+
+    Tags whose key contains problematic characters are dropped. If a StringPool is given,
+    repeated strings are interned in it. Keys and values are taken after fix has run on the tag. If a
+    list applied_fixes is given, the name of every fix which changed one of the tags is
+    appended to it.
+    """
 
+    pooled = string_pool.intern if string_pool is not None else unpooled
     node_attribs = {}
     way_attribs = {}
     way_nodes = []
@@ -573,26 +1060,29 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
     #Fills in node_attribs dictionary
         for item in element.attrib:
             if item in node_attr_fields:
-                node_attribs[item] = element.attrib[item]
+                if item in UNIQUE_ATTRIBS:
+                    node_attribs[item] = element.attrib[item]
+                else:
+                    node_attribs[item] = pooled(element.attrib[item])
     #Fills in secondary tags list of dicts
         for child in element:
+            if key_classifier.classify(child.attrib['k']) == "problemchars":
+                continue
             temp = {}
             temp["id"] = element.attrib['id']
-            temp["value"] = child.attrib['v']
-            child = fix(child)
-            if re.match(problem_chars, child.attrib['k']):
-                pass
+            child = fix(child, applied_fixes)
+            temp["value"] = pooled(child.attrib['v'])
             k = child.attrib['k'].split(":")
             if len(k)==1:
                 temp["type"] = default_tag_type
-                temp["key"] = child.attrib["k"]
+                temp["key"] = pooled(child.attrib["k"])
             if len(k)==2:
-                temp["type"] = k[0]
-                temp["key"] = k[1]
+                temp["type"] = pooled(k[0])
+                temp["key"] = pooled(k[1])
             elif len(k)>2:
                 k = child.attrib['k'].split(":", 1)
-                temp["type"] = k[0]
-                temp["key"] = k[1]
+                temp["type"] = pooled(k[0])
+                temp["key"] = pooled(k[1])
             tags.append(temp)
 
     #Create way data structure
@@ -600,7 +1090,10 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
     #Fills in the way attribs dictionary
         for item in element.attrib:
             if item in way_attr_fields:
-                way_attribs[item] = element.attrib[item]
+                if item in UNIQUE_ATTRIBS:
+                    way_attribs[item] = element.attrib[item]
+                else:
+                    way_attribs[item] = pooled(element.attrib[item])
                 
     #Fills in the way_nodes list
         count = 0
@@ -615,23 +1108,23 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                 
     #Fills in the tags list of dicts for way
             if child.tag == "tag":
+                if key_classifier.classify(child.attrib['k']) == "problemchars":
+                    continue
                 temp2 = {}
                 temp2["id"] = element.attrib["id"]
-                temp2["value"] = child.attrib["v"]
-                if re.match(problem_chars, child.attrib['k']):
-                    pass
-                child =fix(child)
+                child =fix(child, applied_fixes)
+                temp2["value"] = pooled(child.attrib["v"])
                 k = child.attrib['k'].split(":")
                 if len(k)==1:
                     temp2["type"] = default_tag_type
-                    temp2["key"] = child.attrib["k"]
+                    temp2["key"] = pooled(child.attrib["k"])
                 if len(k)==2:
-                    temp2["type"] = k[0]
-                    temp2["key"] = k[1]
+                    temp2["type"] = pooled(k[0])
+                    temp2["key"] = pooled(k[1])
                 elif len(k)>2:
                     k = child.attrib['k'].split(":", 1)
-                    temp2["type"] = k[0]
-                    temp2["key"] = k[1]
+                    temp2["type"] = pooled(k[0])
+                    temp2["key"] = pooled(k[1])
                 way_tags.append(temp2)
                 
     if element.tag == 'node':            
@@ -654,6 +1147,13 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
             yield elem
             root.clear()
 
+def make_validator(validate):
+    """Return a cerberus Validator if validate is True, importing cerberus only then"""
+    if validate is True:
+        import cerberus
+        return cerberus.Validator()
+    return None
+
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
     if validator.validate(element, schema) is not True:
@@ -676,33 +1176,1176 @@ class UnicodeDictWriter(csv.DictWriter, object):
             self.writerow(row)
 
 
+CSV_BUFFER_SIZE = 1 << 20 # Parameter: bytes buffered per output csv before writing to disk
+
+
+def encode_row(row):
+    ''' Returns a row as a list, with unicode values encoded to utf-8 '''
+    return [v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
+
+def row_getter(fields):
+    '''
+    Returns a function turning a shaped dictionary into a tuple in the order of fields.
+    Missing fields are written as '', the same as csv.DictWriter does
+    '''
+    getter = operator.itemgetter(*fields)
+    def get_row(d):
+        try:
+            return getter(d)
+        except KeyError:
+            return tuple(d.get(field, '') for field in fields)
+    return get_row
+
+class UnicodeTupleWriter(object):
+    """Write rows given as tuples in *_FIELDS order to a csv, encoding Unicode values to utf-8
+
+    The output is byte for byte the same as UnicodeDictWriter, without building a dict
+    per row; writerows hands the whole batch to the csv module at once.
+    """
+
+    def __init__(self, f, fieldnames):
+        self.fieldnames = fieldnames
+        self.writer = csv.writer(f)
+
+    def writeheader(self):
+        self.writer.writerow(self.fieldnames)
+
+    def writerow(self, row):
+        self.writer.writerow(encode_row(row))
+
+    def writerows(self, rows):
+        self.writer.writerows([encode_row(row) for row in rows])
+
+
+NODE_ROW = row_getter(NODE_FIELDS)
+NODE_TAGS_ROW = row_getter(NODE_TAGS_FIELDS)
+WAY_ROW = row_getter(WAY_FIELDS)
+WAY_NODES_ROW = row_getter(WAY_NODES_FIELDS)
+WAY_TAGS_ROW = row_getter(WAY_TAGS_FIELDS)
+
+
+def benchmark_csv_writers(n=1000000):
+    '''
+    Writes n ways_nodes rows to os.devnull with UnicodeDictWriter and UnicodeTupleWriter
+    and prints the rows/second of each
+    '''
+    dict_rows = [{'id': '24445245', 'node_id': str(265678142 + i), 'position': i % 50} for i in xrange(n)]
+    tuple_rows = [WAY_NODES_ROW(row) for row in dict_rows]
+    for writer_class, rows in ((UnicodeDictWriter, dict_rows), (UnicodeTupleWriter, tuple_rows)):
+        with open(os.devnull, 'wb', CSV_BUFFER_SIZE) as f:
+            writer = writer_class(f, WAY_NODES_FIELDS)
+            start = time.time()
+            writer.writerows(rows)
+            elapsed = time.time() - start
+        print "{0}: {1:.0f} rows/second".format(writer_class.__name__, n / elapsed)
+
+
+# ================================================== #
+#               Checkpointing                        #
+# ================================================== #
+
+CHECKPOINT_PATH = "process_map.checkpoint"
+CHECKPOINT_EVERY = 100000 # Parameter: save a checkpoint every n-th processed element
+
+CSV_OUTPUTS = [(NODES_PATH, NODE_FIELDS),
+               (NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+               (WAYS_PATH, WAY_FIELDS),
+               (WAY_NODES_PATH, WAY_NODES_FIELDS),
+               (WAY_TAGS_PATH, WAY_TAGS_FIELDS)]
+
+top_level_start = re.compile(r'<(node|way|relation)[\s/>]')
+
+
+class CountingReader(object):
+    """Wrap a file for ET.iterparse, keeping track of how many bytes have been read
+
+    An optional prefix is handed to the parser before the file itself, so parsing can
+    start part way through an OSM file with a fresh <osm> root.
+    """
+
+    def __init__(self, f, prefix=''):
+        self.f = f
+        self.pos = f.tell()
+        self.max_read = 0
+        self.prefix = prefix
+
+    def read(self, size=-1):
+        if self.prefix:
+            data, self.prefix = self.prefix, ''
+            return data
+        data = self.f.read(size)
+        self.pos += len(data)
+        self.max_read = max(self.max_read, len(data))
+        return data
+
+
+def get_element_offsets(reader, tags=('node', 'way')):
+    """Yield (element, offset) pairs, where offset is a byte position in the file at or
+    before the element's start tag
+
+    The parser reads ahead in blocks, so the start tag lies somewhere in the last two
+    blocks read when its start event comes through.
+    """
+    context = ET.iterparse(reader, events=('start', 'end'))
+    _, root = next(context)
+    offset = 0
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in tags:
+                offset = max(0, reader.pos - 2 * reader.max_read)
+        elif elem.tag in tags:
+            yield elem, offset
+            root.clear()
+
+
+def resume_reader(osm_file, offset):
+    '''
+    Seeks osm_file to the first node, way or relation start tag at or after offset
+    Returns:
+        a CountingReader which parses the rest of the file under a new <osm> root
+    '''
+    osm_file.seek(offset)
+    position = offset
+    data = ''
+    while True:
+        block = osm_file.read(1 << 16)
+        if not block:
+            raise Exception("No element found after byte {0} of the input file".format(offset))
+        data += block
+        match = top_level_start.search(data)
+        if match:
+            osm_file.seek(position + match.start())
+            return CountingReader(osm_file, prefix='<osm>')
+        # keep a short tail in case a start tag is split between blocks
+        position += len(data) - 16
+        data = data[-16:]
+
+
+def open_csv(path, fields, position=None):
+    '''
+    Opens a csv for writing and writes its header, or if a checkpointed position is given,
+    truncates the csv there and continues from the end
+    Returns:
+        f, writer: the open file and a UnicodeTupleWriter over it
+    '''
+    if position is None:
+        f = open(path, 'wb', CSV_BUFFER_SIZE)
+        writer = UnicodeTupleWriter(f, fields)
+        writer.writeheader()
+    else:
+        f = open(path, 'r+b', CSV_BUFFER_SIZE)
+        f.truncate(position)
+        f.seek(position)
+        writer = UnicodeTupleWriter(f, fields)
+    return f, writer
+
+
+def save_checkpoint(path, checkpoint, files):
+    '''Flushes the csv files, records their positions in the checkpoint and writes it to path atomically'''
+    outputs = {}
+    for f in files:
+        f.flush()
+        os.fsync(f.fileno())
+        outputs[f.name] = f.tell()
+    checkpoint['outputs'] = outputs
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def load_checkpoint(path, file_in):
+    ''' Returns the checkpoint saved at path, or None if there isn't one '''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        checkpoint = json.load(f)
+    if checkpoint['input'] != file_in:
+        raise Exception("Checkpoint {0} was saved for {1}, not {2}".format(path, checkpoint['input'], file_in))
+    return checkpoint
+
+
+# ================================================== #
+#               Data quality metrics                 #
+# ================================================== #
+
+METRICS_DB_PATH = "quality.db"
+
+METRICS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot TEXT PRIMARY KEY NOT NULL,
+    input TEXT,
+    elements INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS edits_by_month (
+    snapshot TEXT NOT NULL,
+    month TEXT NOT NULL,
+    edits INTEGER NOT NULL,
+    PRIMARY KEY (snapshot, month)
+);
+
+CREATE TABLE IF NOT EXISTS edits_by_changeset (
+    snapshot TEXT NOT NULL,
+    changeset INTEGER NOT NULL,
+    edits INTEGER NOT NULL,
+    PRIMARY KEY (snapshot, changeset)
+);
+
+CREATE TABLE IF NOT EXISTS edits_by_user (
+    snapshot TEXT NOT NULL,
+    user TEXT NOT NULL,
+    edits INTEGER NOT NULL,
+    PRIMARY KEY (snapshot, user)
+);
+
+CREATE TABLE IF NOT EXISTS fixes_by_month (
+    snapshot TEXT NOT NULL,
+    month TEXT NOT NULL,
+    fix TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (snapshot, month, fix)
+);
+'''
+
+
+class QualityMetrics(object):
+    """Histograms of edits by month, changeset and user, and of the fixes applied each month,
+    added to one shaped element at a time during conversion
+
+    An element's month is the first seven characters of its timestamp, e.g. "2016-09".
+    """
+
+    def __init__(self):
+        self.elements = 0
+        self.by_month = Counter()
+        self.by_changeset = Counter()
+        self.by_user = Counter()
+        self.fixes = Counter()  # keyed by (month, fix name)
+
+    def add(self, attribs, applied_fixes):
+        '''
+        Counts one element
+        Args:
+            attribs: the shaped node or way attributes
+            applied_fixes: the names of the fixes applied to its tags, as collected by shape_element
+        '''
+        month = attribs.get('timestamp', '')[:7]
+        self.elements += 1
+        self.by_month[month] += 1
+        self.by_changeset[attribs.get('changeset', '')] += 1
+        self.by_user[attribs.get('user', '')] += 1
+        for name in applied_fixes:
+            self.fixes[(month, name)] += 1
+
+    def state(self):
+        ''' Returns the counts as a JSON serializable dictionary, e.g. to save in a checkpoint '''
+        return {'elements': self.elements,
+                'by_month': dict(self.by_month),
+                'by_changeset': dict(self.by_changeset),
+                'by_user': dict(self.by_user),
+                'fixes': [[month, name, n] for (month, name), n in self.fixes.iteritems()]}
+
+    def load(self, state):
+        ''' Replaces the counts with those from state() '''
+        self.elements = state['elements']
+        self.by_month = Counter(state['by_month'])
+        self.by_changeset = Counter(state['by_changeset'])
+        self.by_user = Counter(state['by_user'])
+        self.fixes = Counter({(month, name): n for month, name, n in state['fixes']})
+
+
+def save_metrics(metrics, snapshot, file_in, db_path=METRICS_DB_PATH):
+    '''
+    Stores the histograms of a QualityMetrics in the summary tables of db_path under the name
+    snapshot, replacing any earlier metrics saved under that name. Other snapshots are kept,
+    so trends can be followed across extracts without reprocessing their XML
+    '''
+    import sqlite3
+    db = sqlite3.connect(db_path)
+    db.executescript(METRICS_SCHEMA)
+    with db:
+        for table in ('snapshots', 'edits_by_month', 'edits_by_changeset', 'edits_by_user', 'fixes_by_month'):
+            db.execute("DELETE FROM {0} WHERE snapshot = ?;".format(table), (snapshot,))
+        db.execute("INSERT INTO snapshots VALUES (?, ?, ?);", (snapshot, file_in, metrics.elements))
+        db.executemany("INSERT INTO edits_by_month VALUES (?, ?, ?);",
+                       [(snapshot, month, n) for month, n in metrics.by_month.iteritems()])
+        db.executemany("INSERT INTO edits_by_changeset VALUES (?, ?, ?);",
+                       [(snapshot, changeset, n) for changeset, n in metrics.by_changeset.iteritems()])
+        db.executemany("INSERT INTO edits_by_user VALUES (?, ?, ?);",
+                       [(snapshot, user, n) for user, n in metrics.by_user.iteritems()])
+        db.executemany("INSERT INTO fixes_by_month VALUES (?, ?, ?, ?);",
+                       [(snapshot, month, name, n) for (month, name), n in metrics.fixes.iteritems()])
+    db.close()
+
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
 
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
+def process_map(file_in, validate, resume=False, checkpoint_path=CHECKPOINT_PATH,
+                checkpoint_every=CHECKPOINT_EVERY, metrics=None):
+    """Iteratively process each XML element and write to csv(s)
+
+    Every checkpoint_every elements the input offset, the last element processed and the
+    csv positions are saved to checkpoint_path. With resume=True an interrupted run carries
+    on from its last checkpoint, appending to the csvs rather than starting over.
+    If a QualityMetrics is given, every element and the fixes applied to it are added to it.
+    """
+
+    checkpoint = load_checkpoint(checkpoint_path, file_in) if resume else None
+    positions = checkpoint['outputs'] if checkpoint else {}
+    if metrics is not None and checkpoint and 'metrics' in checkpoint:
+        metrics.load(checkpoint['metrics'])
+
+    outputs = [open_csv(path, fields, positions.get(path)) for path, fields in CSV_OUTPUTS]
+    files = [f for f, _ in outputs]
+    nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer = [w for _, w in outputs]
+
+    validator = make_validator(validate)
+
+    try:
+        with open(file_in, 'rb') as osm_file:
+            if checkpoint:
+                reader = resume_reader(osm_file, checkpoint['offset'])
+                count = checkpoint['elements']
+            else:
+                reader = CountingReader(osm_file)
+                count = 0
+            # When resuming, skip forward past the last element written before the checkpoint
+            skipping = checkpoint is not None
+
+            for element, offset in get_element_offsets(reader, tags=('node', 'way')):
+                if skipping:
+                    skipping = not (element.tag == checkpoint['tag'] and element.get('id') == checkpoint['id'])
+                    continue
+
+                applied_fixes = [] if metrics is not None else None
+                el = shape_element(element, applied_fixes=applied_fixes)
+                if el:
+                    if validate is True:
+                        validate_element(el, validator)
+                    if metrics is not None:
+                        metrics.add(el[element.tag], applied_fixes)
+
+                    if element.tag == 'node':
+                        nodes_writer.writerow(NODE_ROW(el['node']))
+                        node_tags_writer.writerows([NODE_TAGS_ROW(tag) for tag in el['node_tags']])
+                    elif element.tag == 'way':
+                        ways_writer.writerow(WAY_ROW(el['way']))
+                        way_nodes_writer.writerows([WAY_NODES_ROW(nd) for nd in el['way_nodes']])
+                        way_tags_writer.writerows([WAY_TAGS_ROW(tag) for tag in el['way_tags']])
+
+                count += 1
+                if checkpoint_every and count % checkpoint_every == 0:
+                    checkpoint_state = {'input': file_in,
+                                        'offset': offset,
+                                        'tag': element.tag,
+                                        'id': element.get('id'),
+                                        'elements': count}
+                    if metrics is not None:
+                        checkpoint_state['metrics'] = metrics.state()
+                    save_checkpoint(checkpoint_path, checkpoint_state, files)
+
+            if skipping:
+                raise Exception("Checkpointed {0} {1} was not found in {2}".format(checkpoint['tag'], checkpoint['id'], file_in))
+    finally:
+        for f in files:
+            f.close()
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+# ================================================== #
+#               Pipelined processing                 #
+# ================================================== #
+
+PIPELINE_CHUNK_SIZE = 1 << 20 # Parameter: bytes of XML handed to a worker at a time
+PIPELINE_QUEUE_SIZE = 8 # Parameter: chunks allowed to wait between two stages
+PIPELINE_POLL = 1.0 # Parameter: seconds a stage waits on a queue before checking that the others are still running
+
+
+def read_chunks(osm_file, chunk_size=PIPELINE_CHUNK_SIZE):
+    '''
+    Reading stage: yields pieces of an OSM file, each made of whole top level elements
+    The text before the first element and the closing </osm> tag are left out
+    '''
+    data = ''
+    started = False
+    while True:
+        block = osm_file.read(chunk_size)
+        data += block
+        if not started:
+            match = top_level_start.search(data)
+            if not match:
+                if not block:
+                    return
+                continue
+            data = data[match.start():]
+            started = True
+        if not block:
+            end = data.rfind('</osm>')
+            yield data[:end] if end != -1 else data
+            return
+        # split before the last element start tag, which may not be complete yet
+        last = None
+        for last in top_level_start.finditer(data, 1):
+            pass
+        if last:
+            yield data[:last.start()]
+            data = data[last.start():]
+
+
+def shape_worker(chunks, results, validate):
+    '''
+    Parsing and shaping stage, run in a worker process: turns chunks of XML into csv rows
+    Args:
+        chunks: queue of (index, XML chunk from read_chunks), ended by None
+        results: queue receiving (index, rows, error), where rows holds one list of tuples
+                 per csv in CSV_OUTPUTS order; None is put when the worker finishes
+        validate: whether to validate each shaped element against the schema
+    '''
+    validator = make_validator(validate)
+    for index, chunk in iter(chunks.get, None):
+        try:
+            rows = [[], [], [], [], []]
+            # Strings repeated within the chunk are pickled once
+            string_pool = StringPool()
+            for element in get_element(cStringIO.StringIO('<osm>' + chunk + '</osm>'), tags=('node', 'way')):
+                el = shape_element(element, string_pool=string_pool)
+                if el:
+                    if validate is True:
+                        validate_element(el, validator)
+                    if element.tag == 'node':
+                        rows[0].append(NODE_ROW(el['node']))
+                        rows[1].extend(NODE_TAGS_ROW(tag) for tag in el['node_tags'])
+                    elif element.tag == 'way':
+                        rows[2].append(WAY_ROW(el['way']))
+                        rows[3].extend(WAY_NODES_ROW(nd) for nd in el['way_nodes'])
+                        rows[4].extend(WAY_TAGS_ROW(tag) for tag in el['way_tags'])
+            results.put((index, rows, None))
+        except Exception:
+            results.put((index, None, traceback.format_exc()))
+    results.put(None)
+
+
+def check_shapers(shapers, errors, stop):
+    '''
+    Stops the pipeline if a worker process has died, e.g. killed by a signal or for lack of
+    memory, without reporting an error or finishing
+    '''
+    for shaper in shapers:
+        if shaper.exitcode not in (None, 0):
+            errors.append("Shaping process {0} exited with code {1}".format(shaper.pid, shaper.exitcode))
+            stop.set()
+
+
+def put_unless_stopped(queue, item, stop, shapers, errors):
+    '''
+    Puts item on a bounded queue, giving up if the pipeline stops while the queue is full
+    Returns:
+        put: whether the item was put
+    '''
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=PIPELINE_POLL)
+            return True
+        except Queue.Full:
+            check_shapers(shapers, errors, stop)
+    return False
+
+
+def collect_rows(results, shapers, writer_queues, errors, stop, in_flight):
+    '''
+    Collecting stage, run in a thread: puts shaped chunks back in input order and hands
+    each csv's rows to its writer queue. Worker errors are appended to errors and stop
+    the pipeline, as does a worker process dying
+    Each chunk handed on takes a token from in_flight, letting the reader send another,
+    so chunks held out of order while an earlier one is slow are bounded too
+    '''
+    pending = {}
+    next_index = 0
+    done = 0
+    try:
+        while done < len(shapers) and not stop.is_set():
+            try:
+                item = results.get(timeout=PIPELINE_POLL)
+            except Queue.Empty:
+                check_shapers(shapers, errors, stop)
+                continue
+            if item is None:
+                done += 1
+                continue
+            index, rows, error = item
+            if error:
+                errors.append(error)
+                stop.set()
+                break
+            pending[index] = rows
+            while next_index in pending:
+                rows = pending.pop(next_index)
+                for queue, csv_rows in zip(writer_queues, rows):
+                    if csv_rows:
+                        queue.put(csv_rows)
+                in_flight.get_nowait()
+                next_index += 1
+    except Exception:
+        errors.append(traceback.format_exc())
+        stop.set()
+    finally:
+        # The writers drain their queues even after an error, so these puts cannot block for ever
+        for queue in writer_queues:
+            queue.put(None)
+
+
+def write_rows(queue, writer, errors, stop):
+    '''
+    Writing stage, run in a thread per csv: writes each list of rows from queue until None
+    If writing fails, e.g. on a full disk, the error is appended to errors, the pipeline is
+    stopped and the rest of the queue is read and dropped so the collector is not held up
+    '''
+    for rows in iter(queue.get, None):
+        if stop.is_set():
+            continue
+        try:
+            writer.writerows(rows)
+        except Exception:
+            errors.append(traceback.format_exc())
+            stop.set()
+
+
+def process_map_pipelined(file_in, validate, workers=None, chunk_size=PIPELINE_CHUNK_SIZE,
+                          queue_size=PIPELINE_QUEUE_SIZE):
+    """Process the XML like process_map, with reading, parsing/shaping and writing running concurrently
+
+    The main thread reads the file in chunks of whole elements, worker processes parse,
+    shape and validate them, and a thread per csv writes. Stages are joined by queues
+    holding at most queue_size chunks, so a slow stage holds back the ones before it and
+    memory stays bounded. Rows are written in the same order as process_map.
+    At most queue_size + workers chunks are between the reader and the writers at once,
+    counting those the collector holds to put back in order.
+    The first error in any stage, or a worker process dying, stops the pipeline: no more
+    chunks are read or written, and the error is raised.
+    """
+
+    if workers is None:
+        workers = max(1, multiprocessing.cpu_count() - 1)
+    chunks = multiprocessing.Queue(queue_size)
+    results = multiprocessing.Queue(queue_size)
+
+    # Fork the shaping workers before any files are opened or threads started
+    shapers = [multiprocessing.Process(target=shape_worker, args=(chunks, results, validate))
+               for _ in range(workers)]
+    for shaper in shapers:
+        shaper.daemon = True
+        shaper.start()
+
+    outputs = [open_csv(path, fields) for path, fields in CSV_OUTPUTS]
+    writer_queues = [Queue.Queue(queue_size) for _ in outputs]
+    errors = []
+    stop = threading.Event()
+    # A bounded queue of tokens works as a semaphore which can be waited on with a timeout
+    in_flight = Queue.Queue(queue_size + workers)
+    threads = [threading.Thread(target=collect_rows, args=(results, shapers, writer_queues, errors, stop, in_flight))]
+    threads += [threading.Thread(target=write_rows, args=(queue, writer, errors, stop))
+                for queue, (_, writer) in zip(writer_queues, outputs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        with open(file_in, 'rb') as osm_file:
+            for index, chunk in enumerate(read_chunks(osm_file, chunk_size)):
+                if not (put_unless_stopped(in_flight, index, stop, shapers, errors) and
+                        put_unless_stopped(chunks, (index, chunk), stop, shapers, errors)):
+                    break
+        for _ in shapers:
+            put_unless_stopped(chunks, None, stop, shapers, errors)
+        for thread in threads:
+            thread.join()
+    finally:
+        stop.set()
+        for shaper in shapers:
+            if shaper.is_alive():
+                shaper.terminate()
+        for f, _ in outputs:
+            f.close()
+
+    if errors:
+        raise Exception(errors[0])
+
+
+def benchmark_pipeline(filename, workers=None):
+    '''
+    Converts filename without validation once with process_map and once with
+    process_map_pipelined, in a temporary directory, and prints the MB/second of each
+    '''
+    size = os.path.getsize(filename) / float(1 << 20)
+    filename = os.path.abspath(filename)
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        os.chdir(directory)
+        for name, convert in (('process_map', lambda: process_map(filename, False, checkpoint_every=0)),
+                              ('process_map_pipelined', lambda: process_map_pipelined(filename, False, workers))):
+            start = time.time()
+            convert()
+            elapsed = time.time() - start
+            print "{0}: {1:.1f} MB/second".format(name, size / elapsed)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+# ================================================== #
+#               Diffing two extracts                 #
+# ================================================== #
 
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
+DIFF_PATH = "diff.csv"
 
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+DIFF_FIELDS = ['action', 'element', 'id', 'key', 'old_value', 'new_value']
 
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
+# OSM files list nodes, then ways, then relations, each sorted by id
+ELEMENT_ORDER = {'node': 0, 'way': 1}
 
-        validator = cerberus.Validator()
 
+def element_records(filename, keep_xml=False):
+    '''
+    Yields a dictionary for each node and way of an OSM file sorted by type and id, holding
+    its sort key, tag, attributes, tags and node refs (and its XML if keep_xml is set).
+    Elements are cleared once read, so memory does not grow with the file
+    '''
+    last = None
+    for element in get_element(filename):
+        if element.tag not in ELEMENT_ORDER:
+            continue
+        key = (ELEMENT_ORDER[element.tag], int(element.attrib['id']))
+        if last is not None and key <= last:
+            raise Exception("{0} is not sorted: {1} {2} follows {3}".format(filename, element.tag, key[1], last[1]))
+        last = key
+        record = {'key': key,
+                  'tag': element.tag,
+                  'attrib': dict(element.attrib),
+                  'tags': dict((child.attrib['k'], child.attrib['v']) for child in element if child.tag == 'tag'),
+                  'refs': [child.attrib['ref'] for child in element if child.tag == 'nd']}
+        if keep_xml:
+            record['xml'] = ET.tostring(element, encoding='utf-8').strip()
+        yield record
+
+def record_changes(old, new):
+    '''
+    Returns the differences between two versions of an element as a list of
+    (action, key, old_value, new_value): tag_added, tag_removed and tag_changed for tags,
+    attribute_changed for lat and lon, and nodes_changed for a way's node refs
+    '''
+    changes = []
+    for attr in ('lat', 'lon'):
+        if old['attrib'].get(attr) != new['attrib'].get(attr):
+            changes.append(('attribute_changed', attr, old['attrib'].get(attr, ''), new['attrib'].get(attr, '')))
+    for key in sorted(set(old['tags']) | set(new['tags'])):
+        if key not in new['tags']:
+            changes.append(('tag_removed', key, old['tags'][key], ''))
+        elif key not in old['tags']:
+            changes.append(('tag_added', key, '', new['tags'][key]))
+        elif old['tags'][key] != new['tags'][key]:
+            changes.append(('tag_changed', key, old['tags'][key], new['tags'][key]))
+    if old['refs'] != new['refs']:
+        changes.append(('nodes_changed', 'nd', ' '.join(old['refs']), ' '.join(new['refs'])))
+    return changes
+
+def diff_extracts(old_file, new_file, keep_xml=False):
+    '''
+    Merge-joins the nodes and ways of two OSM files sorted by type and id, reading each once
+    Yields:
+        (action, old, new): action is "create", "delete" or "modify", old and new are the
+        element_records of the element in each file (None where it is missing). Elements
+        whose version, coordinates, tags and node refs are all unchanged are skipped
+    '''
+    old_records = element_records(old_file, keep_xml)
+    new_records = element_records(new_file, keep_xml)
+    old = next(old_records, None)
+    new = next(new_records, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old['key'] < new['key']):
+            yield 'delete', old, None
+            old = next(old_records, None)
+        elif old is None or new['key'] < old['key']:
+            yield 'create', None, new
+            new = next(new_records, None)
+        else:
+            if old['attrib'].get('version') != new['attrib'].get('version') or record_changes(old, new):
+                yield 'modify', old, new
+            old = next(old_records, None)
+            new = next(new_records, None)
+
+def write_diff(old_file, new_file, diff_path=DIFF_PATH, osc_path=None):
+    '''
+    Diffs two OSM extracts with diff_extracts and writes a row to diff_path for each created,
+    deleted or modified element followed by a row for each of its changes. If osc_path is
+    given the changes are also written there as an osmChange file
+    Returns:
+        counts: a dictionary of (action, element) and how many elements had that change
+    '''
+    counts = defaultdict(int)
+    with open(diff_path, 'wb', CSV_BUFFER_SIZE) as diff_file:
+        writer = UnicodeTupleWriter(diff_file, DIFF_FIELDS)
+        writer.writeheader()
+        osc = open(osc_path, 'wb', CSV_BUFFER_SIZE) if osc_path else None
+        try:
+            if osc:
+                osc.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                osc.write('<osmChange version="0.6" generator="OpenStreetMapCaseStudy">\n')
+            for action, old, new in diff_extracts(old_file, new_file, keep_xml=osc is not None):
+                record = new or old
+                tag, element_id = record['tag'], record['attrib']['id']
+                counts[(action, tag)] += 1
+                if action == 'create':
+                    changes = [('tag_added', k, '', v) for k, v in sorted(new['tags'].iteritems())]
+                    versions = ('', new['attrib'].get('version', ''))
+                elif action == 'delete':
+                    changes = [('tag_removed', k, v, '') for k, v in sorted(old['tags'].iteritems())]
+                    versions = (old['attrib'].get('version', ''), '')
+                else:
+                    changes = record_changes(old, new)
+                    versions = (old['attrib'].get('version', ''), new['attrib'].get('version', ''))
+                writer.writerow((action, tag, element_id, 'version') + versions)
+                writer.writerows([(change, tag, element_id, key, old_value, new_value)
+                                  for change, key, old_value, new_value in changes])
+                if osc:
+                    osc.write('  <{0}>\n    {1}\n  </{0}>\n'.format(action, record['xml']))
+            if osc:
+                osc.write('</osmChange>\n')
+        finally:
+            if osc:
+                osc.close()
+    return dict(counts)
+
+
+# ================================================== #
+#               Referential integrity                #
+# ================================================== #
+
+DANGLING_PATH = "dangling_refs.csv"
+UNUSED_PATH = "unused_nodes.csv"
+
+DANGLING_FIELDS = ['id', 'node_id', 'position']
+UNUSED_FIELDS = ['id']
+
+ID_ARRAY_LIMIT = 4096 # Parameter: ids kept as a sorted array in a 65536 id range before it becomes a bitmap
+
+
+class NodeIdSet(object):
+    """A compact set of non-negative integer ids, stored the way a roaring bitmap is
+
+    Ids are split by their high bits into ranges of 65536. A range holding few ids keeps
+    their low 16 bits in a sorted array of 2 byte values; once it holds more than
+    ID_ARRAY_LIMIT it switches to an 8 KB bitmap. Memory is therefore at most 2 bytes per
+    id and never more than one bit per possible id, whatever the number of ids.
+    """
+
+    def __init__(self):
+        self.chunks = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, n):
+        high, low = n >> 16, n & 0xFFFF
+        chunk = self.chunks.get(high)
+        if chunk is None:
+            self.chunks[high] = array('H', [low])
+        elif isinstance(chunk, bytearray):
+            bit = 1 << (low & 7)
+            if chunk[low >> 3] & bit:
+                return
+            chunk[low >> 3] |= bit
+        else:
+            # OSM ids mostly arrive in order, so this is nearly always an append
+            if chunk[-1] < low:
+                chunk.append(low)
+            else:
+                i = bisect.bisect_left(chunk, low)
+                if chunk[i] == low:
+                    return
+                chunk.insert(i, low)
+            if len(chunk) > ID_ARRAY_LIMIT:
+                bitmap = bytearray(8192)
+                for value in chunk:
+                    bitmap[value >> 3] |= 1 << (value & 7)
+                self.chunks[high] = bitmap
+        self.size += 1
+
+    def __contains__(self, n):
+        chunk = self.chunks.get(n >> 16)
+        if chunk is None:
+            return False
+        low = n & 0xFFFF
+        if isinstance(chunk, bytearray):
+            return bool(chunk[low >> 3] & (1 << (low & 7)))
+        i = bisect.bisect_left(chunk, low)
+        return i < len(chunk) and chunk[i] == low
+
+    def __iter__(self):
+        ''' Yields the ids in increasing order '''
+        for high in sorted(self.chunks):
+            chunk = self.chunks[high]
+            base = high << 16
+            if isinstance(chunk, bytearray):
+                for byte_index, byte in enumerate(chunk):
+                    if byte:
+                        for bit in range(8):
+                            if byte & (1 << bit):
+                                yield base + (byte_index << 3) + bit
+            else:
+                for low in chunk:
+                    yield base + low
+
+
+def write_unused_nodes(nodes, referenced, unused_path):
+    '''
+    Writes the nodes which are in nodes but not in referenced to a csv
+    Returns:
+        unused: the number of unused nodes
+    '''
+    unused = 0
+    with open(unused_path, 'wb', CSV_BUFFER_SIZE) as f:
+        writer = UnicodeTupleWriter(f, UNUSED_FIELDS)
+        writer.writeheader()
+        for node_id in nodes:
+            if node_id not in referenced:
+                writer.writerow((node_id,))
+                unused += 1
+    return unused
+
+def check_way_refs(nodes, way_refs, dangling_path, unused_path):
+    '''
+    Checks (way id, node id, position) refs against the node ids collected so far, writing each
+    dangling ref to dangling_path as it is found so that memory does not grow with them, and
+    then writes the unused nodes
+    Args:
+        nodes: a NodeIdSet, which way_refs may go on adding to as it is consumed
+        way_refs: an iterable of (way id, node id, position) tuples
+    Returns:
+        counts: a dictionary with the number of nodes, referenced nodes, dangling refs and unused nodes
+    '''
+    referenced = NodeIdSet()
+    dangling = 0
+    with open(dangling_path, 'wb', CSV_BUFFER_SIZE) as f:
+        writer = UnicodeTupleWriter(f, DANGLING_FIELDS)
+        writer.writeheader()
+        for way_id, node_id, position in way_refs:
+            if node_id in nodes:
+                referenced.add(node_id)
+            else:
+                writer.writerow((way_id, node_id, position))
+                dangling += 1
+    unused = write_unused_nodes(nodes, referenced, unused_path)
+    return {'nodes': len(nodes), 'referenced': len(referenced), 'dangling': dangling, 'unused': unused}
+
+def check_references(filename, dangling_path=DANGLING_PATH, unused_path=UNUSED_PATH):
+    '''
+    Checks in a single pass over an OSM file, which lists its nodes before its ways, that
+    every way's nd refs are to nodes in the file. Node ids are collected in a NodeIdSet
+    while the nodes are read and each ref is looked up as its way is read
+    Returns:
+        counts: as from check_way_refs
+    '''
+    nodes = NodeIdSet()
+
+    def way_refs():
+        for element in get_element(filename, tags=('node', 'way', 'relation')):
+            if element.tag == 'node':
+                nodes.add(int(element.attrib['id']))
+            elif element.tag == 'way':
+                position = 0
+                for child in element:
+                    if child.tag == 'nd':
+                        yield element.attrib['id'], int(child.attrib['ref']), position
+                        position += 1
+
+    return check_way_refs(nodes, way_refs(), dangling_path, unused_path)
+
+def check_csv_references(nodes_path=NODES_PATH, way_nodes_path=WAY_NODES_PATH,
+                         dangling_path=DANGLING_PATH, unused_path=UNUSED_PATH):
+    '''
+    Checks that every node_id in ways_nodes.csv is an id in nodes.csv
+    Returns:
+        counts: as from check_way_refs
+    '''
+    nodes = NodeIdSet()
+    with open(nodes_path, 'rb') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            nodes.add(int(row[0]))
+
+    def way_refs():
+        with open(way_nodes_path, 'rb') as f:
+            reader = csv.reader(f)
+            next(reader)
+            for way_id, node_id, position in reader:
+                yield way_id, int(node_id), position
+
+    return check_way_refs(nodes, way_refs(), dangling_path, unused_path)
+
+
+# ================================================== #
+#               Road graph                           #
+# ================================================== #
+
+GRAPH_PATH = "roads.graph"
+GRAPH_MAGIC = 'OSMGRPH1'
+GRAPH_HEADER = '<8sQQQ' # magic, vertex count, edge count, reserved
+
+# Sections of the graph file in the order they are written, with their little endian struct
+# codes and whether they have one item per vertex ('V'), per vertex plus one ('V+1') or per
+# edge ('E'). The 8 byte sections come first, so every section is aligned to its item size.
+GRAPH_SECTIONS = [('offsets', 'Q', 'V+1'),   # edges of vertex i are offsets[i] to offsets[i+1]
+                  ('node_ids', 'q', 'V'),
+                  ('lats', 'd', 'V'),
+                  ('lons', 'd', 'V'),
+                  ('way_ids', 'q', 'E'),     # way each edge was taken from
+                  ('targets', 'I', 'E'),     # vertex index each edge goes to
+                  ('lengths', 'f', 'E')]     # edge length in metres
+
+NON_ROUTABLE = set(['proposed', 'construction', 'abandoned', 'platform', 'razed'])
+EARTH_RADIUS = 6371008.8 # metres
+
+
+def distance(lat1, lon1, lat2, lon2):
+    ''' Returns the great circle distance in metres between two points '''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+def road_direction(tags):
+    '''
+    Returns:
+        direction: 1 if the road is one way along its nodes, -1 if one way against them and 0 otherwise
+    '''
+    oneway = tags.get('oneway')
+    if oneway in ('yes', 'true', '1'):
+        return 1
+    if oneway == '-1':
+        return -1
+    if oneway is None and (tags.get('junction') == 'roundabout' or tags.get('highway') == 'motorway'):
+        return 1
+    return 0
+
+def read_roads(filename):
+    '''
+    Reads the routable highway ways of an OSM file, and then the coordinates of only their nodes,
+    so that memory grows with the road network rather than the extract
+    Returns:
+        roads: a list of (way id, node ids, direction) tuples
+        coords: a dictionary of node id to (lat, lon) for the nodes on roads
+        uses: a Counter of how many times each node appears in roads
+    '''
+    roads = []
+    uses = Counter()
+    for element in get_element(filename, tags=('node', 'way', 'relation')):
+        if element.tag != 'way':
+            continue
+        tags = dict((tag.attrib['k'], tag.attrib['v']) for tag in element.iter('tag'))
+        if 'highway' not in tags or tags['highway'] in NON_ROUTABLE or tags.get('area') == 'yes':
+            continue
+        refs = tuple(int(nd.attrib['ref']) for nd in element.iter('nd'))
+        if len(refs) < 2:
+            continue
+        roads.append((int(element.attrib['id']), refs, road_direction(tags)))
+        uses.update(refs)
+
+    coords = {}
+    for element in get_element(filename, tags=('node', 'way', 'relation')):
+        if element.tag == 'node':
+            node_id = int(element.attrib['id'])
+            if node_id in uses:
+                coords[node_id] = (float(element.attrib['lat']), float(element.attrib['lon']))
+    return roads, coords, uses
+
+def road_segments(refs, coords, uses):
+    '''
+    Splits a road's nodes at every node it shares with a road (or with itself), at its ends
+    and around nodes missing from the extract
+    Returns:
+        segments: a list of (first node id, last node id, length in metres) tuples
+    '''
+    segments = []
+    start = previous = None
+    length = 0.0
+    for i, node_id in enumerate(refs):
+        if node_id not in coords:
+            if previous is not None and previous != start:
+                segments.append((start, previous, length))
+            start = previous = None
+            continue
+        if previous is None:
+            start, length = node_id, 0.0
+        else:
+            length += distance(*(coords[previous] + coords[node_id]))
+            if uses[node_id] > 1 or i == len(refs) - 1 or refs[i + 1] not in coords:
+                segments.append((start, node_id, length))
+                start, length = node_id, 0.0
+        previous = node_id
+    return segments
+
+def write_packed(f, code, values, chunk=1 << 16):
+    ''' Writes values as little endian struct items '''
+    for i in range(0, len(values), chunk):
+        part = values[i:i + chunk]
+        f.write(struct.pack('<%d%s' % (len(part), code), *part))
+
+def build_road_graph(filename=OSM_PATH, graph_path=GRAPH_PATH):
+    '''
+    Builds a directed graph of the routable highway ways in an OSM file, with a vertex for every
+    road end and every node shared by roads, and writes it in compressed sparse row form to
+    graph_path, laid out as GRAPH_HEADER followed by GRAPH_SECTIONS. The file can be memory
+    mapped, for instance with numpy.memmap at the offsets given by graph_sections
+    Returns:
+        counts: a dictionary with the number of vertices and edges
+    '''
+    roads, coords, uses = read_roads(filename)
+
+    vertices = {}
+    node_ids = []
+    sources, targets, lengths, way_ids = array('I'), array('I'), array('f'), []
+    def vertex(node_id):
+        if node_id not in vertices:
+            vertices[node_id] = len(node_ids)
+            node_ids.append(node_id)
+        return vertices[node_id]
+    for way_id, refs, direction in roads:
+        for first, last, length in road_segments(refs, coords, uses):
+            first, last = vertex(first), vertex(last)
+            if direction >= 0:
+                sources.append(first); targets.append(last); lengths.append(length); way_ids.append(way_id)
+            if direction <= 0:
+                sources.append(last); targets.append(first); lengths.append(length); way_ids.append(way_id)
+    del roads, uses
+
+    # Counting sort of the edges by source vertex
+    offsets = [0] * (len(node_ids) + 1)
+    for source in sources:
+        offsets[source + 1] += 1
+    for i in range(len(node_ids)):
+        offsets[i + 1] += offsets[i]
+    order = array('I', [0]) * len(sources)
+    fill = offsets[:-1]
+    for edge, source in enumerate(sources):
+        order[fill[source]] = edge
+        fill[source] += 1
+    del fill, sources
+
+    sections = {'offsets': offsets,
+                'node_ids': node_ids,
+                'lats': [coords[node_id][0] for node_id in node_ids],
+                'lons': [coords[node_id][1] for node_id in node_ids],
+                'way_ids': [way_ids[edge] for edge in order],
+                'targets': [targets[edge] for edge in order],
+                'lengths': [lengths[edge] for edge in order]}
+    with open(graph_path, 'wb') as f:
+        f.write(struct.pack(GRAPH_HEADER, GRAPH_MAGIC, len(node_ids), len(order), 0))
+        for name, code, _ in GRAPH_SECTIONS:
+            write_packed(f, code, sections[name])
+    return {'vertices': len(node_ids), 'edges': len(order)}
+
+def graph_sections(graph_path=GRAPH_PATH):
+    '''
+    Reads the header of a graph file
+    Returns:
+        sections: a dictionary of section name to (struct code, byte offset, item count)
+    '''
+    with open(graph_path, 'rb') as f:
+        magic, vertex_count, edge_count, _ = struct.unpack(GRAPH_HEADER, f.read(struct.calcsize(GRAPH_HEADER)))
+    if magic != GRAPH_MAGIC:
+        raise ValueError("{0} is not a road graph file".format(graph_path))
+    counts = {'V': vertex_count, 'V+1': vertex_count + 1, 'E': edge_count}
+    sections = {}
+    offset = struct.calcsize(GRAPH_HEADER)
+    for name, code, size in GRAPH_SECTIONS:
+        sections[name] = (code, offset, counts[size])
+        offset += struct.calcsize('<' + code) * counts[size]
+    return sections
+
+
+# ================================================== #
+#          Dictionary encoded CSV files              #
+# ================================================== #
+
+# The encoded csvs have the plain csvs' names, so they are written to a directory of their own
+ENCODED_DIR = "encoded"
+KEYS_PATH = "keys.csv"
+VALUES_PATH = "values.csv"
+USERS_PATH = "users.csv"
+
+KEYS_FIELDS = ['id', 'key']
+VALUES_FIELDS = ['id', 'value']
+USERS_FIELDS = ['id', 'user']
+
+# The same columns as the plain csvs, with user, key and value replaced by ids into the lookup tables
+ENCODED_NODE_FIELDS = ['id', 'lat', 'lon', 'user_id', 'uid', 'version', 'changeset', 'timestamp']
+ENCODED_NODE_TAGS_FIELDS = ['id', 'key_id', 'value_id', 'type']
+ENCODED_WAY_FIELDS = ['id', 'user_id', 'uid', 'version', 'changeset', 'timestamp']
+ENCODED_WAY_TAGS_FIELDS = ['id', 'key_id', 'value_id', 'type']
+
+ENCODED_CSV_OUTPUTS = [(os.path.join(ENCODED_DIR, path), fields) for path, fields in
+                       [(NODES_PATH, ENCODED_NODE_FIELDS),
+                        (NODE_TAGS_PATH, ENCODED_NODE_TAGS_FIELDS),
+                        (WAYS_PATH, ENCODED_WAY_FIELDS),
+                        (WAY_NODES_PATH, WAY_NODES_FIELDS),
+                        (WAY_TAGS_PATH, ENCODED_WAY_TAGS_FIELDS),
+                        (KEYS_PATH, KEYS_FIELDS),
+                        (VALUES_PATH, VALUES_FIELDS),
+                        (USERS_PATH, USERS_FIELDS)]]
+
+
+class StringDictionary(object):
+    """Number strings 1, 2, 3... in order of first appearance, writing each new
+    (id, string) pair to a lookup csv"""
+
+    def __init__(self, writer):
+        self.ids = {}
+        self.writer = writer
+
+    def encode(self, s):
+        try:
+            return self.ids[s]
+        except KeyError:
+            string_id = self.ids[s] = len(self.ids) + 1
+            self.writer.writerow((string_id, s))
+            return string_id
+
+
+def encode_tag_rows(tags, keys, values):
+    ''' Returns the shaped tags of an element as csv rows with key and value ids '''
+    return [(tag['id'], keys.encode(tag['key']), values.encode(tag['value']), tag['type']) for tag in tags]
+
+
+def process_map_encoded(file_in, validate):
+    """Process the XML like process_map, writing dictionary encoded csvs
+
+    Distinct tag keys, tag values and user names are written once each to keys.csv,
+    values.csv and users.csv, and nodes, ways and their tags refer to them by integer id.
+    The csvs are written to ENCODED_DIR and loaded with load_encoded_database.
+    """
+
+    if not os.path.isdir(ENCODED_DIR):
+        os.makedirs(ENCODED_DIR)
+    outputs = [open_csv(path, fields) for path, fields in ENCODED_CSV_OUTPUTS]
+    (nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer,
+     keys_writer, values_writer, users_writer) = [w for _, w in outputs]
+    keys = StringDictionary(keys_writer)
+    values = StringDictionary(values_writer)
+    users = StringDictionary(users_writer)
+
+    validator = make_validator(validate)
+
+    try:
         for element in get_element(file_in, tags=('node', 'way')):
             el = shape_element(element)
             if el:
@@ -710,75 +2353,675 @@ def process_map(file_in, validate):
                     validate_element(el, validator)
 
                 if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
+                    row = list(NODE_ROW(el['node']))
+                    row[3] = users.encode(row[3])
+                    nodes_writer.writerow(row)
+                    node_tags_writer.writerows(encode_tag_rows(el['node_tags'], keys, values))
                 elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+                    row = list(WAY_ROW(el['way']))
+                    row[1] = users.encode(row[1])
+                    ways_writer.writerow(row)
+                    way_nodes_writer.writerows([WAY_NODES_ROW(nd) for nd in el['way_nodes']])
+                    way_tags_writer.writerows(encode_tag_rows(el['way_tags'], keys, values))
+    finally:
+        for f, _ in outputs:
+            f.close()
 
 
-if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
-    process_map(OSM_PATH, validate=True)
+# ================================================== #
+#               Partitioned CSV files                #
+# ================================================== #
+
+PARTITION_DIR = "partitions"
+MANIFEST_PATH = "manifest.json"
+TILE_SIZE = 0.1 # Parameter: width and height of a tile in degrees
+PARTITION_BUFFER = 10000 # Parameter: rows held for a partition before they are appended to its csvs
+UNPLACED = 'unplaced' # partition of ways whose first node is not in the extract
+
+
+def tile_name(lat, lon, tile_size=TILE_SIZE):
+    ''' Returns the name of the tile containing a point, from the row and column of the tile '''
+    return "tile_{0}_{1}".format(int(math.floor(lat / tile_size)), int(math.floor(lon / tile_size)))
+
+def tile_bbox(name, tile_size=TILE_SIZE):
+    '''
+    Returns:
+        bbox: [min lat, min lon, max lat, max lon] of a tile, or None for UNPLACED
+    '''
+    if name == UNPLACED:
+        return None
+    row, column = [int(n) for n in name.split('_')[1:]]
+    return [round(row * tile_size, 9), round(column * tile_size, 9),
+            round((row + 1) * tile_size, 9), round((column + 1) * tile_size, 9)]
+
+
+class NodePartitions(object):
+    """A compact map of node id to partition number
+
+    Like NodeIdSet, ids are split by their high bits into ranges of 65536; each range keeps
+    the low 16 bits of its ids in a sorted array of 2 byte values beside an array of 4 byte
+    partition numbers. That is 6 bytes a node rather than the ~100 of a dictionary entry,
+    so the whole extract's nodes fit in memory alongside the tiles.
+    """
+
+    def __init__(self):
+        self.chunks = {}
+
+    def __setitem__(self, n, partition):
+        high, low = n >> 16, n & 0xFFFF
+        if high not in self.chunks:
+            self.chunks[high] = array('H'), array('I')
+        lows, partitions = self.chunks[high]
+        # OSM ids mostly arrive in order, so this is nearly always an append
+        if not lows or lows[-1] < low:
+            lows.append(low)
+            partitions.append(partition)
+            return
+        i = bisect.bisect_left(lows, low)
+        if lows[i] == low:
+            partitions[i] = partition
+        else:
+            lows.insert(i, low)
+            partitions.insert(i, partition)
+
+    def get(self, n, default=None):
+        chunk = self.chunks.get(n >> 16)
+        if chunk is None:
+            return default
+        lows, partitions = chunk
+        low = n & 0xFFFF
+        i = bisect.bisect_left(lows, low)
+        if i < len(lows) and lows[i] == low:
+            return partitions[i]
+        return default
+
+
+class PartitionWriter(object):
+    """Writes rows to a set of csvs for each partition
+
+    Rows are held per partition and csv and appended to the partition's files once
+    PARTITION_BUFFER of them have built up, so no more than one file is open at a time
+    however many partitions there are. Row counts and the bounding box of each
+    partition's nodes are kept for the manifest.
+    """
+
+    def __init__(self, directory, outputs=CSV_OUTPUTS, buffer_size=PARTITION_BUFFER):
+        self.directory = directory
+        self.outputs = outputs
+        self.buffer_size = buffer_size
+        self.rows = defaultdict(lambda: [[] for _ in outputs])
+        self.buffered = Counter()
+        self.counts = defaultdict(lambda: [0] * len(outputs))
+        self.bboxes = {}
+
+    def path(self, partition, csv_path):
+        return os.path.join(self.directory, partition, csv_path)
+
+    def add_node(self, partition, lat, lon):
+        bbox = self.bboxes.get(partition)
+        if bbox is None:
+            self.bboxes[partition] = [lat, lon, lat, lon]
+        else:
+            bbox[0], bbox[1] = min(bbox[0], lat), min(bbox[1], lon)
+            bbox[2], bbox[3] = max(bbox[2], lat), max(bbox[3], lon)
+
+    def writerows(self, partition, output, rows):
+        self.rows[partition][output].extend(rows)
+        self.counts[partition][output] += len(rows)
+        self.buffered[partition] += len(rows)
+        if self.buffered[partition] >= self.buffer_size:
+            self.flush(partition)
+
+    def flush(self, partition):
+        if not os.path.isdir(os.path.join(self.directory, partition)):
+            os.makedirs(os.path.join(self.directory, partition))
+        for (csv_path, fields), rows in zip(self.outputs, self.rows[partition]):
+            path = self.path(partition, csv_path)
+            new = not os.path.exists(path)
+            with open(path, 'ab', CSV_BUFFER_SIZE) as f:
+                writer = UnicodeTupleWriter(f, fields)
+                if new:
+                    writer.writeheader()
+                writer.writerows(rows)
+            del rows[:]
+        self.buffered[partition] = 0
+
+    def close(self, tile_size=TILE_SIZE, manifest_path=MANIFEST_PATH):
+        '''
+        Flushes every partition and writes the manifest, which lists each partition's files and
+        row counts, the bounding box of its tile and the bounding box of its nodes
+        '''
+        manifest = {'tile_size': tile_size, 'partitions': {}}
+        for partition in sorted(self.counts):
+            self.flush(partition)
+            manifest['partitions'][partition] = {
+                'tile_bbox': tile_bbox(partition, tile_size),
+                'node_bbox': self.bboxes.get(partition),
+                'files': dict((csv_path, {'path': os.path.join(partition, csv_path), 'rows': count})
+                              for (csv_path, _), count in zip(self.outputs, self.counts[partition]))}
+        write_json(os.path.join(self.directory, manifest_path), manifest)
+        return manifest
+
+
+def process_map_partitioned(file_in, validate, directory=PARTITION_DIR, tile_size=TILE_SIZE):
+    """Process the XML like process_map, writing the five csvs once for each tile
+
+    Nodes go to the tile they lie in and ways, with their nodes and tags, to the tile of their
+    first node. Each tile's csvs are written to a directory of its own under directory, along
+    with manifest.json, which gives the bounding boxes and row counts of every tile.
+    Everything is written to directory + '.tmp', which is renamed to directory at the end, so
+    an interrupted run never leaves partial csvs to be appended to; directory must not hold
+    any files already. The tile of every node is kept, in a NodePartitions, to place the ways.
+    """
 
+    if os.path.isdir(directory) and os.listdir(directory):
+        raise Exception("{0} is not empty".format(directory))
+    tmp = directory + '.tmp'
+    if os.path.exists(tmp):
+        # left by an interrupted run
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    writer = PartitionWriter(tmp)
+    node_partitions = NodePartitions()
+    partitions = {}
+    partition_names = []
+
+    validator = make_validator(validate)
+
+    for element in get_element(file_in, tags=('node', 'way')):
+        el = shape_element(element)
+        if el:
+            if validate is True:
+                validate_element(el, validator)
+
+            if element.tag == 'node':
+                lat, lon = float(el['node']['lat']), float(el['node']['lon'])
+                partition = tile_name(lat, lon, tile_size)
+                if partition not in partitions:
+                    partitions[partition] = len(partition_names)
+                    partition_names.append(partition)
+                node_partitions[int(el['node']['id'])] = partitions[partition]
+                writer.add_node(partition, lat, lon)
+                writer.writerows(partition, 0, [NODE_ROW(el['node'])])
+                writer.writerows(partition, 1, [NODE_TAGS_ROW(tag) for tag in el['node_tags']])
+            elif element.tag == 'way':
+                first = int(el['way_nodes'][0]['node_id']) if el['way_nodes'] else None
+                number = node_partitions.get(first) if first is not None else None
+                partition = partition_names[number] if number is not None else UNPLACED
+                writer.writerows(partition, 2, [WAY_ROW(el['way'])])
+                writer.writerows(partition, 3, [WAY_NODES_ROW(nd) for nd in el['way_nodes']])
+                writer.writerows(partition, 4, [WAY_TAGS_ROW(tag) for tag in el['way_tags']])
+
+    manifest = writer.close(tile_size)
+    if os.path.isdir(directory):
+        os.rmdir(directory)
+    os.rename(tmp, directory)
+    return manifest
 
 
 # ================================================== #
-#               SQL Querying                         #
+#               GeoJSON export                       #
 # ================================================== #
 
+GEOJSON_PATH = "santiago.geojsonl"
+AREA_KEYS = set(['building', 'landuse', 'leisure', 'natural', 'amenity', 'place', 'boundary']) # closed ways with these keys are polygons
 
-'''Fetch records from santiago.db'''
 
-db = sqlite3.connect("santiago.db")
-c = db.cursor()
+COORDINATE_SCALE = 10 ** 7 # OSM stores coordinates to 7 decimal places
 
-def execute_query(QUERY):
-    '''executes an SQL query and prints the results '''
-    c.execute(QUERY)
-    rows = c.fetchall()
-    pprint.pprint(rows)
 
+class NodeCoordinates(object):
+    """A compact map of node id to [lon, lat]
 
-nodes_count = '''
+    Laid out like NodePartitions: each range of 65536 ids keeps the low 16 bits of its ids
+    in a sorted array of 2 byte values, beside arrays of the latitudes and longitudes as 4
+    byte integers in units of 1e-7 degrees, the precision OSM stores them at. That is 10
+    bytes a node rather than a few hundred for a dictionary entry holding a list.
+    """
+
+    def __init__(self):
+        self.chunks = {}
+
+    def __contains__(self, n):
+        return self.get(n) is not None
+
+    def add(self, n, lat, lon):
+        high, low = n >> 16, n & 0xFFFF
+        if high not in self.chunks:
+            self.chunks[high] = array('H'), array('i'), array('i')
+        lows, lats, lons = self.chunks[high]
+        lat, lon = int(round(lat * COORDINATE_SCALE)), int(round(lon * COORDINATE_SCALE))
+        # OSM ids mostly arrive in order, so this is nearly always an append
+        if not lows or lows[-1] < low:
+            lows.append(low)
+            lats.append(lat)
+            lons.append(lon)
+            return
+        i = bisect.bisect_left(lows, low)
+        if lows[i] == low:
+            lats[i], lons[i] = lat, lon
+        else:
+            lows.insert(i, low)
+            lats.insert(i, lat)
+            lons.insert(i, lon)
+
+    def get(self, n, default=None):
+        ''' Returns the [lon, lat] of a node, in GeoJSON order '''
+        chunk = self.chunks.get(n >> 16)
+        if chunk is None:
+            return default
+        lows, lats, lons = chunk
+        low = n & 0xFFFF
+        i = bisect.bisect_left(lows, low)
+        if i < len(lows) and lows[i] == low:
+            return [lons[i] / float(COORDINATE_SCALE), lats[i] / float(COORDINATE_SCALE)]
+        return default
+
+
+def tag_dict(tags, default_tag_type='regular'):
+    ''' Returns the shaped tags of an element as a dictionary of full key to value '''
+    return dict((tag['key'] if tag['type'] == default_tag_type else tag['type'] + ':' + tag['key'], tag['value'])
+                for tag in tags)
+
+def parse_tag_filters(filters):
+    '''
+    Args:
+        filters: strings of the form key=value, or key alone to match any value
+    Returns:
+        tag_filters: a list of (key, value) tuples, where value is None if any value matches
+    '''
+    tag_filters = []
+    for f in filters or []:
+        key, _, value = f.partition('=')
+        tag_filters.append((key, value if _ else None))
+    return tag_filters
+
+def matches(tags, tag_filters):
+    ''' Returns True if there are no tag filters or the tags match any of them '''
+    if not tag_filters:
+        return True
+    for key, value in tag_filters:
+        if key in tags and (value is None or tags[key] == value):
+            return True
+    return False
+
+def may_match(raw_tags, tag_filters):
+    '''
+    Returns True if tags, as they are before fix() has run, match the tag filters or might
+    once fixed: filters on keys fix() produces match any element with a key fix() changes
+    '''
+    if matches(raw_tags, tag_filters):
+        return True
+    return any(key in fix_output_keys for key, _ in tag_filters) and not fix_input_keys.isdisjoint(raw_tags)
+
+def way_geometry(tags, coordinates):
+    '''
+    Returns:
+        geometry: a GeoJSON Polygon for closed ways which are areas, a LineString for other
+        ways, or None if fewer than two of the way's nodes are in the extract
+    '''
+    if len(coordinates) < 2:
+        return None
+    closed = len(coordinates) >= 4 and coordinates[0] == coordinates[-1]
+    if closed and tags.get('area') != 'no' and (tags.get('area') == 'yes' or AREA_KEYS.intersection(tags)):
+        return {'type': 'Polygon', 'coordinates': [coordinates]}
+    return {'type': 'LineString', 'coordinates': coordinates}
+
+def write_feature(f, element_type, element_id, geometry, tags):
+    f.write(json.dumps({'type': 'Feature', 'id': element_type + '/' + element_id,
+                        'geometry': geometry, 'properties': tags}, separators=(',', ':')))
+    f.write('\n')
+
+def export_geojson(file_in, geojson_path=GEOJSON_PATH, filters=None):
+    """Writes the shaped and fixed nodes and ways of an OSM file as newline delimited GeoJSON features
+
+    A first pass over the raw ways, without shaping or fixing them, finds the nodes used by
+    the ways which may be exported, so that only their coordinates are kept, in a
+    NodeCoordinates. A second pass writes each matching node as a Point as it is read,
+    and each matching way as a LineString or Polygon. Features are written one per line,
+    with the cleaned tags as properties, and can be filtered by tag as in parse_tag_filters.
+    Returns:
+        counts: a Counter of features written by element type
+    """
+
+    tag_filters = parse_tag_filters(filters)
+    way_node_ids = NodeIdSet()
+    for element in get_element(file_in, tags=('node', 'way')):
+        if element.tag == 'way':
+            raw_tags = dict((tag.attrib['k'], tag.attrib['v']) for tag in element.iter('tag'))
+            if may_match(raw_tags, tag_filters):
+                for nd in element.iter('nd'):
+                    way_node_ids.add(int(nd.attrib['ref']))
+
+    coords = NodeCoordinates()
+    counts = Counter()
+    with open(geojson_path, 'wb', CSV_BUFFER_SIZE) as f:
+        for element in get_element(file_in, tags=('node', 'way')):
+            el = shape_element(element)
+            if element.tag == 'node':
+                node = el['node']
+                point = [float(node['lon']), float(node['lat'])]
+                if int(node['id']) in way_node_ids:
+                    coords.add(int(node['id']), point[1], point[0])
+                tags = tag_dict(el['node_tags'])
+                if tags and matches(tags, tag_filters):
+                    write_feature(f, 'node', node['id'], {'type': 'Point', 'coordinates': point}, tags)
+                    counts['node'] += 1
+            elif element.tag == 'way':
+                tags = tag_dict(el['way_tags'])
+                if matches(tags, tag_filters):
+                    coordinates = [point for point in (coords.get(int(nd['node_id'])) for nd in el['way_nodes'])
+                                   if point is not None]
+                    geometry = way_geometry(tags, coordinates)
+                    if geometry is not None:
+                        write_feature(f, 'way', el['way']['id'], geometry, tags)
+                        counts['way'] += 1
+    return counts
+
+
+# ================================================== #
+#               Loading the database                 #
+# ================================================== #
+
+DB_PATH = "santiago.db"
+
+SQL_SCHEMA = '''
+DROP TABLE IF EXISTS nodes;
+DROP TABLE IF EXISTS nodes_tags;
+DROP TABLE IF EXISTS ways;
+DROP TABLE IF EXISTS ways_tags;
+DROP TABLE IF EXISTS ways_nodes;
+
+CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat REAL,
+    lon REAL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE nodes_tags (
+    id INTEGER,
+    key TEXT,
+    value TEXT,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES nodes(id)
+);
+
+CREATE TABLE ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES ways(id)
+);
+
+CREATE TABLE ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id),
+    FOREIGN KEY (node_id) REFERENCES nodes(id)
+);
+'''
+
+# Tables and views either schema creates, dropped before a load whichever kind they are
+DB_OBJECTS = ['nodes', 'nodes_tags', 'ways', 'ways_tags', 'ways_nodes',
+              'encoded_nodes', 'encoded_nodes_tags', 'encoded_ways', 'encoded_ways_tags',
+              'tag_keys', 'tag_values', 'users']
+
+# Dictionary encoded tables, with views under the plain table names so the report
+# queries and the name index read them unchanged. Lookups by key or value text go
+# through the unique indexes of tag_keys and tag_values and then the (key_id, value_id)
+# indexes, rather than comparing text in every tag row
+ENCODED_SQL_SCHEMA = '''
+CREATE TABLE tag_keys (
+    id INTEGER PRIMARY KEY NOT NULL,
+    key TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE tag_values (
+    id INTEGER PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE encoded_nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat REAL,
+    lon REAL,
+    user_id INTEGER REFERENCES users(id),
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE encoded_nodes_tags (
+    id INTEGER,
+    key_id INTEGER NOT NULL REFERENCES tag_keys(id),
+    value_id INTEGER NOT NULL REFERENCES tag_values(id),
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES encoded_nodes(id)
+);
+
+CREATE TABLE encoded_ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user_id INTEGER REFERENCES users(id),
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE encoded_ways_tags (
+    id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL REFERENCES tag_keys(id),
+    value_id INTEGER NOT NULL REFERENCES tag_values(id),
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES encoded_ways(id)
+);
+
+CREATE TABLE ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES encoded_ways(id),
+    FOREIGN KEY (node_id) REFERENCES encoded_nodes(id)
+);
+
+CREATE INDEX encoded_nodes_tags_key ON encoded_nodes_tags (key_id, value_id);
+CREATE INDEX encoded_ways_tags_key ON encoded_ways_tags (key_id, value_id);
+
+CREATE VIEW nodes AS
+SELECT n.id, n.lat, n.lon, u.user, n.uid, n.version, n.changeset, n.timestamp
+FROM encoded_nodes n LEFT JOIN users u ON u.id = n.user_id;
+
+CREATE VIEW nodes_tags AS
+SELECT t.id, k.key, v.value, t.type
+FROM encoded_nodes_tags t JOIN tag_keys k ON k.id = t.key_id JOIN tag_values v ON v.id = t.value_id;
+
+CREATE VIEW ways AS
+SELECT w.id, u.user, w.uid, w.version, w.changeset, w.timestamp
+FROM encoded_ways w LEFT JOIN users u ON u.id = w.user_id;
+
+CREATE VIEW ways_tags AS
+SELECT t.id, k.key, v.value, t.type
+FROM encoded_ways_tags t JOIN tag_keys k ON k.id = t.key_id JOIN tag_values v ON v.id = t.value_id;
+'''
+
+CSV_TABLES = [(NODES_PATH, 'nodes', NODE_FIELDS),
+              (NODE_TAGS_PATH, 'nodes_tags', NODE_TAGS_FIELDS),
+              (WAYS_PATH, 'ways', WAY_FIELDS),
+              (WAY_TAGS_PATH, 'ways_tags', WAY_TAGS_FIELDS),
+              (WAY_NODES_PATH, 'ways_nodes', WAY_NODES_FIELDS)]
+
+ENCODED_CSV_TABLES = [(os.path.join(ENCODED_DIR, path), table, fields) for path, table, fields in
+                      [(KEYS_PATH, 'tag_keys', KEYS_FIELDS),
+                       (VALUES_PATH, 'tag_values', VALUES_FIELDS),
+                       (USERS_PATH, 'users', USERS_FIELDS),
+                       (NODES_PATH, 'encoded_nodes', ENCODED_NODE_FIELDS),
+                       (NODE_TAGS_PATH, 'encoded_nodes_tags', ENCODED_NODE_TAGS_FIELDS),
+                       (WAYS_PATH, 'encoded_ways', ENCODED_WAY_FIELDS),
+                       (WAY_TAGS_PATH, 'encoded_ways_tags', ENCODED_WAY_TAGS_FIELDS),
+                       (WAY_NODES_PATH, 'ways_nodes', WAY_NODES_FIELDS)]]
+
+# Full text index over name, addr:street and operator values. remove_diacritics folds
+# accents, so "penalolen" matches "Peñalolén"; the prefix indexes speed up prefix queries
+NAME_SEARCH_SCHEMA = '''
+DROP TABLE IF EXISTS name_search;
+
+CREATE VIRTUAL TABLE name_search USING fts5(
+    value,
+    key UNINDEXED,
+    element UNINDEXED,
+    id UNINDEXED,
+    tokenize = "unicode61 remove_diacritics 2",
+    prefix = '2 3'
+);
+'''
+
+NAME_SEARCH_INSERT = '''
+INSERT INTO name_search (value, key, element, id)
+SELECT value, CASE type WHEN 'regular' THEN key ELSE type || ':' || key END, ?, id
+FROM {0}
+WHERE (type = 'regular' AND key IN ('name', 'operator'))
+   OR (type = 'addr' AND key = 'street');
+'''
+
+
+def read_csv_rows(path, fields=None):
+    '''
+    Yields the rows of a csv written by process_map decoded to unicode, skipping the header
+    If fields are given, raises an exception unless the header is those fields, so that e.g.
+    dictionary encoded csvs are not loaded as plain ones
+    '''
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        if fields is not None and header != fields:
+            raise Exception("{0} has columns {1}, expected {2}".format(path, header, fields))
+        for row in reader:
+            yield [v.decode('utf-8') for v in row]
+
+def build_name_index(db):
+    ''' (Re)builds the name_search full text index from the nodes_tags and ways_tags tables '''
+    db.executescript(NAME_SEARCH_SCHEMA)
+    with db:
+        db.execute(NAME_SEARCH_INSERT.format('nodes_tags'), ('node',))
+        db.execute(NAME_SEARCH_INSERT.format('ways_tags'), ('way',))
+
+def drop_objects(db, names=DB_OBJECTS):
+    ''' Drops the tables and views with the given names '''
+    for name, kind in db.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view');").fetchall():
+        if name in names:
+            db.execute("DROP {0} {1};".format(kind.upper(), name))
+
+def load_database(db_path=DB_PATH, schema=SQL_SCHEMA, csv_tables=CSV_TABLES):
+    ''' Creates the tables in db_path, loads the five csvs into them and builds the name search index '''
+    import sqlite3
+    db = sqlite3.connect(db_path)
+    drop_objects(db)
+    db.executescript(schema)
+    with db:
+        for path, table, fields in csv_tables:
+            insert = "INSERT INTO {0} VALUES ({1});".format(table, ", ".join("?" * len(fields)))
+            db.executemany(insert, read_csv_rows(path, fields))
+    build_name_index(db)
+    # Write ahead logging lets report queries read while the database is being written
+    db.execute("PRAGMA journal_mode = WAL;")
+    db.close()
+
+def load_encoded_database(db_path=DB_PATH):
+    '''
+    Loads the dictionary encoded csvs from ENCODED_DIR with their lookup tables; views
+    under the plain table names decode them for the report queries and the name index
+    '''
+    load_database(db_path, ENCODED_SQL_SCHEMA, ENCODED_CSV_TABLES)
+
+def search_names(db, text, keys=None, prefix=True, limit=20):
+    '''
+    Searches name, addr:street and operator values, ignoring case and accents
+    Args:
+        db: a connection to a database built by load_database
+        text: the words to look for, all of which must match
+        keys: optionally, the keys to search, e.g. ['addr:street']
+        prefix: whether words also match longer words they start, e.g. "provi" finds "Providencia"
+        limit: the largest number of results returned
+    Returns:
+        results: a list of (element, id, key, value) tuples, best match first
+    '''
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    terms = [u'"{0}"'.format(word.replace(u'"', u'""')) for word in text.split()]
+    if not terms:
+        return []
+    if prefix:
+        terms = [term + u'*' for term in terms]
+
+    query = "SELECT element, id, key, value FROM name_search WHERE name_search MATCH ?"
+    params = [u" ".join(terms)]
+    if keys:
+        query += " AND key IN ({0})".format(", ".join("?" * len(keys)))
+        params.extend(keys)
+    query += " ORDER BY rank LIMIT ?;"
+    params.append(limit)
+    return db.execute(query, params).fetchall()
+
+
+
+# ================================================== #
+#               SQL Querying                         #
+# ================================================== #
+
+
+'''Queries reported on santiago.db, as (name, title, query)'''
+
+REPORT_QUERIES = [
+    ('nodes_count', "The number nodes:", '''
 SELECT COUNT(*)
 FROM nodes;
-'''
-print "The number nodes:"
-execute_query(nodes_count)
+'''),
 
-#Count the number of ways
-ways_count = '''
+    # Count the number of ways
+    ('ways_count', "The number ways:", '''
 SELECT COUNT(*)
 FROM ways;
-'''
-print "The number ways:"
-execute_query(ways_count)
+'''),
 
-#Count the number of distinct users
-users = '''
+    # Count the number of distinct users
+    ('users', "The number distinct users:", '''
 SELECT COUNT(DISTINCT(uid))          
 FROM (SELECT uid FROM nodes 
 UNION SELECT uid FROM ways);
-'''
-print "The number distinct users:"
-execute_query(users)
+'''),
 
-#Display top ten users and their contributions
-top10u = '''
+    # Display top ten users and their contributions
+    ('top10u', "The top ten contributing users:", '''
 SELECT nodes_ways.user, COUNT(*) as num
 FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) nodes_ways
 GROUP BY nodes_ways.user
 ORDER BY num DESC
-LIMIT 10; '''
+LIMIT 10; '''),
 
-print "The top ten contributing users:"
-execute_query(top10u)
-
-#Finds the top five amenity tags from the top user 'Julio_Costa_Zambelli'
-Juliotop5 = '''
+    # Finds the top five amenity tags from the top user 'Julio_Costa_Zambelli'
+    ('Juliotop5', "Top five amenities from the top user, Julio_Costa_Zambelli :", '''
 SELECT tags.value, COUNT(*) as count 
 FROM (SELECT key, user, value FROM (nodes JOIN nodes_tags ON nodes.id=nodes_tags.id) UNION ALL 
 SELECT key, user, value FROM (ways JOIN ways_tags ON ways.id=ways_tags.id))tags
@@ -787,85 +3030,63 @@ WHERE tags.user =  'Julio_Costa_Zambelli'
 and tags.key = 'amenity'
 GROUP BY tags.value
 ORDER BY count DESC
-limit 5; '''
-
-print "Top five amenities from the top user, Julio_Costa_Zambelli :"
-execute_query(Juliotop5)
+limit 5; '''),
 
-#Counts the number of users contributing once
-onehitwonder = '''
+    # Counts the number of users contributing once
+    ('onehitwonder', "Number of users contributing once:", '''
 SELECT COUNT(*) 
 FROM
     (SELECT e.user, COUNT(*) as num
      FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e
      GROUP BY e.user
-     HAVING num=1)  u;'''
+     HAVING num=1)  u;'''),
 
-print "Number of users contributing once:"
-execute_query(onehitwonder)
-
-#Prints the number of users contributing more than 10,000 elements
-tenthou = '''
+    # Prints the number of users contributing more than 10,000 elements
+    ('tenthou', "Number of users with over one thousand contributions:", '''
 SELECT COUNT(*) 
 FROM
     (SELECT e.user, COUNT(*) as num
      FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e
      GROUP BY e.user
-     HAVING num>10000)  u;'''
-
-print "Number of users with over one thousand contributions:"
-execute_query(tenthou)
+     HAVING num>10000)  u;'''),
 
-tenthou2 = '''
+    ('tenthou2', "Number of users with over one thousand contributions:", '''
 SELECT sum(u.num) 
 FROM
     (SELECT e.user, COUNT(*) as num
      FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e
      GROUP BY e.user
-     HAVING num>10000)  u;'''
+     HAVING num>10000)  u;'''),
 
-print "Number of users with over one thousand contributions:"
-execute_query(tenthou2)
-
-#Comunas of Santiago listed by most common
-comunas = '''
+    # Comunas of Santiago listed by most common
+    ('comunas', "Comunas of Santiago listed from most to least data points", '''
 SELECT tags.value, COUNT(*) as count 
 FROM (SELECT * FROM nodes_tags UNION ALL 
       SELECT * FROM ways_tags) tags
 WHERE tags.key LIKE '%city'
 GROUP BY tags.value
-ORDER BY count DESC; '''
-
-print "Comunas of Santiago listed from most to least data points"
-execute_query(comunas)
-
+ORDER BY count DESC; '''),
 
-#Finds the number of entries under various tags with the "is_in" key
-comunas2 = '''
+    # Finds the number of entries under various tags with the "is_in" key
+    ('comunas2', " 'Is-in' tags listed from most to least data points", '''
 SELECT value, COUNT(*) as num
 FROM nodes_tags
 WHERE key='is_in'
 GROUP BY value
 ORDER BY num DESC
-LIMIT 10;'''
+LIMIT 10;'''),
 
-print " 'Is-in' tags listed from most to least data points"
-execute_query(comunas2)
-
-#Lists the top ten most common amenities
-top10amen = '''
+    # Lists the top ten most common amenities
+    ('top10amen', "Top 10 amenities", '''
 SELECT value, COUNT(*) as num
 FROM nodes_tags
 WHERE key='amenity'
 GROUP BY value
 ORDER BY num DESC
-LIMIT 10;'''
-
-print "Top 10 amenities"
-execute_query(top10amen)
+LIMIT 10;'''),
 
-#Top school operators 
-schools = '''
+    # Top school operators
+    ('schools', "Top school operators", '''
 SELECT nodes_tags.value, COUNT(*) as num
 FROM nodes_tags 
     JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='school') i
@@ -873,37 +3094,26 @@ FROM nodes_tags
 WHERE nodes_tags.key='operator'
 GROUP BY nodes_tags.value
 ORDER BY num DESC;
-'''
+'''),
 
-print "Top school operators"
-execute_query(schools)
-
-#Values for the "highway" key from most to least common
-highway = '''
+    # Values for the "highway" key from most to least common
+    ('highway', "Top highway values", '''
 SELECT value, COUNT(*) as num
 FROM nodes_tags
 WHERE key='highway' 
 GROUP BY value
-ORDER BY num DESC;'''
-
-print "Top highway values"
-execute_query(highway)
-
+ORDER BY num DESC;'''),
 
-#Values for the "railway" key from most to least common
-railway = '''
+    # Values for the "railway" key from most to least common
+    ('railway', "Top railway values", '''
 SELECT value, COUNT(*) as num
 FROM nodes_tags
 WHERE key='railway' 
 GROUP BY value
-ORDER BY num DESC;'''
+ORDER BY num DESC;'''),
 
-print "Top railway values"
-execute_query(railway)
-
-
-#Top 20 types of restaurants
-rest = '''
+    # Top 20 types of restaurants
+    ('rest', "Top 20 types of restaurants", '''
 SELECT nodes_tags.value, COUNT(*) as num
 FROM nodes_tags 
     JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='restaurant') i
@@ -911,25 +3121,19 @@ FROM nodes_tags
 WHERE nodes_tags.key='cuisine'
 GROUP BY nodes_tags.value
 ORDER BY num DESC
-LIMIT 20;'''
+LIMIT 20;'''),
 
-print "Top 20 types of restaurants"
-execute_query(rest)
-
-#Top 10 data sources
-sources = '''
+    # Top 10 data sources
+    ('sources', "Top 10 data sources", '''
 SELECT value, COUNT(*) as num
 FROM nodes_tags
 WHERE key='source'
 GROUP BY value
 ORDER BY num DESC
-LIMIT 10;'''
-
-print "Top 10 data sources"
-execute_query(data)
+LIMIT 10;'''),
 
-#Top ten amenities in Providencia
-provi_amen = '''
+    # Top ten amenities in Providencia
+    ('provi_amen', "Top 10 amenities in Providencia", '''
 SELECT nodes_tags.value, COUNT(*) as num
 FROM nodes_tags 
     JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='Providencia') i
@@ -937,13 +3141,10 @@ FROM nodes_tags
 WHERE nodes_tags.key='amenity'
 GROUP BY nodes_tags.value
 ORDER BY num DESC
-LIMIT 10;'''
+LIMIT 10;'''),
 
-print "Top 10 amenities in Providencia"
-execute_query(provi_amen)
-
-#Top ten comunas with bicycle parking
-bici = '''
+    # Top ten comunas with bicycle parking
+    ('bici', "Top 10 comunas with bicycle parking", '''
 SELECT nodes_tags.value, COUNT(*) as num
 FROM nodes_tags 
     JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='bicycle_parking') i
@@ -951,13 +3152,10 @@ FROM nodes_tags
 WHERE nodes_tags.key LIKE '%city'
 GROUP BY nodes_tags.value
 ORDER BY num DESC
-LIMIT 10;'''
-
-print "Top 10 comunas with bicycle parking"
-execute_query(bici)
+LIMIT 10;'''),
 
-#Top ten comunas by bus stop
-busstops = '''
+    # Top ten comunas by bus stop
+    ('busstops', "Top 10 comunas with busstops", '''
 SELECT nodes_tags.value, COUNT(*) as num
 FROM nodes_tags 
     JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='bus_stop') i
@@ -965,13 +3163,10 @@ FROM nodes_tags
 WHERE nodes_tags.key LIKE '%city'
 GROUP BY nodes_tags.value
 ORDER BY num DESC
-LIMIT 10;'''
-
-print "Top 10 comunas with busstops"
-execute_query(busstops)
+LIMIT 10;'''),
 
-#Top ten comunas by number of schools
-schoolcomunas = '''
+    # Top ten comunas by number of schools
+    ('schoolcomunas', "Top 10 comunas with schools", '''
 SELECT nodes_tags.value, COUNT(*) as num
 FROM nodes_tags 
     JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='school') i
@@ -979,13 +3174,10 @@ FROM nodes_tags
 WHERE nodes_tags.key LIKE '%city'
 GROUP BY nodes_tags.value
 ORDER BY num DESC
-Limit 10;'''
+Limit 10;'''),
 
-print "Top 10 comunas with schools"
-execute_query(schoolcomunas)
-
-#Top ten amenities in Lo Barnechea
-lobaamen = '''
+    # Top ten amenities in Lo Barnechea
+    ('lobaamen', "Top 10 comunas amenities in Lo Barnechea", '''
 SELECT nodes_tags.value, COUNT(*) as num
 FROM nodes_tags 
     JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='Lo Barnechea') i
@@ -993,13 +3185,10 @@ FROM nodes_tags
 WHERE nodes_tags.key='amenity'
 GROUP BY nodes_tags.value
 ORDER BY num DESC
-LIMIT 10;'''
-
-print "Top 10 comunas amenities in Lo Barnechea"
-execute_query(lobaamen)
+LIMIT 10;'''),
 
-#Top ten comunas by number of restaurants
-restcomunas = '''
+    # Top ten comunas by number of restaurants
+    ('restcomunas', "Top 10 comunas with restaurants", '''
 SELECT nodes_tags.value, COUNT(*) as num
 FROM nodes_tags 
     JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='restaurant') i
@@ -1007,13 +3196,10 @@ FROM nodes_tags
 WHERE nodes_tags.key LIKE '%city'
 GROUP BY nodes_tags.value
 ORDER BY num DESC
-Limit 10;'''
-
-print "Top 10 comunas with restaurants"
-execute_query(restcomunas)
+Limit 10;'''),
 
-#Top ten comunas by number of banks
-bankcomunas = '''
+    # Top ten comunas by number of banks
+    ('bankcomunas', "Top 10 comunas with banks", '''
 SELECT nodes_tags.value, COUNT(*) as num
 FROM nodes_tags 
     JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value='bank') i
@@ -1021,9 +3207,233 @@ FROM nodes_tags
 WHERE nodes_tags.key LIKE '%city'
 GROUP BY nodes_tags.value
 ORDER BY num DESC
-Limit 10;'''
+Limit 10;'''),
+]
 
-print "Top 10 comunas with banks"
-execute_query(bankcomunas)
 
-db.close()
\ No newline at end of file
+def execute_query(cursor, QUERY):
+    '''executes an SQL query and prints the results '''
+    cursor.execute(QUERY)
+    rows = cursor.fetchall()
+    pprint.pprint(rows)
+
+REPORT_WORKERS = 4 # Parameter: report queries run at the same time, each on its own connection
+
+
+def connect_read_only(db_path):
+    '''
+    Opens a connection to db_path that refuses writes
+    The connection may be used, and closed, from any thread
+    '''
+    import sqlite3
+    if not os.path.exists(db_path):
+        raise IOError("No database at {0}".format(db_path))
+    db = sqlite3.connect(db_path, check_same_thread=False)
+    db.execute("PRAGMA query_only = ON;")
+    return db
+
+def run_report(db_path=DB_PATH, queries=REPORT_QUERIES, workers=REPORT_WORKERS):
+    '''
+    Runs report queries concurrently in a pool of threads, each thread holding its own read
+    only connection. sqlite releases the GIL while a query runs, so the report takes about
+    as long as its slowest query
+    Args:
+        db_path: a database built by load_database
+        queries: a list of (name, title, query)
+        workers: the number of threads, and so of connections
+    Returns:
+        results: a list with a dictionary for each query, in the order of queries, holding
+                 its name, title, columns, rows and seconds taken
+    '''
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def run(entry):
+        name, title, query = entry
+        if not hasattr(local, 'db'):
+            local.db = connect_read_only(db_path)
+            with lock:
+                connections.append(local.db)
+        start = time.time()
+        cursor = local.db.execute(query)
+        rows = cursor.fetchall()
+        return {'name': name,
+                'title': title,
+                'columns': [column[0] for column in cursor.description],
+                'rows': rows,
+                'seconds': time.time() - start}
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(run, queries, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        for db in connections:
+            db.close()
+
+def write_report_json(results, path):
+    ''' Writes the results of run_report to a JSON file '''
+    with open(path, 'wb') as f:
+        json.dump(results, f, indent=2)
+
+def write_report_csvs(results, directory):
+    ''' Writes the rows of each result of run_report to <name>.csv in directory, headed by its columns '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for result in results:
+        with open(os.path.join(directory, result['name'] + '.csv'), 'wb') as f:
+            writer = UnicodeTupleWriter(f, result['columns'])
+            writer.writeheader()
+            writer.writerows(result['rows'])
+
+def report(db_path=DB_PATH, output_format='print', output=None, workers=REPORT_WORKERS):
+    '''
+    Fetches records from the database with run_report and prints the result of each report
+    query, or writes them all to output as JSON or as a directory of csvs
+    '''
+    results = run_report(db_path, workers=workers)
+    if output_format == 'json':
+        write_report_json(results, output or 'report.json')
+    elif output_format == 'csv':
+        write_report_csvs(results, output or 'report')
+    else:
+        for result in results:
+            print result['title']
+            pprint.pprint(result['rows'])
+
+
+# ================================================== #
+#               Command line                         #
+# ================================================== #
+
+def main(argv=None):
+    '''
+    Runs one step of the case study from the command line:
+        sample   writes a sample of the osm file and prints its first elements and node tags
+        audit    prints the audits of an osm file
+        convert  shapes an osm file into the five csvs
+        load     loads the csvs into the database
+        report   runs the report queries and prints or saves their results
+        diff     writes the differences between two osm extracts
+        check    writes the way node refs missing from the nodes, and the nodes no way uses
+        graph    writes the road network as a memory mappable graph
+        geojson  writes the cleaned nodes and ways as newline delimited GeoJSON
+    '''
+    parser = argparse.ArgumentParser(description="Wrangle and query OpenStreetMap data for Santiago")
+    commands = parser.add_subparsers(dest='command')
+
+    sample = commands.add_parser('sample', help="write a sample of an osm file")
+    sample.add_argument('--input', default=OSM_FILE)
+    sample.add_argument('--output', default=SAMPLE_FILE)
+    sample.add_argument('-k', type=int, default=k, help="take every k-th top level element")
+
+    audit_parser = commands.add_parser('audit', help="print the audits of an osm file")
+    audit_parser.add_argument('--input', default=SAMPLE_FILE)
+    audit_parser.add_argument('--users-input', default=OSM_FILE, help="osm file to count unique users in")
+
+    convert = commands.add_parser('convert', help="shape an osm file into csvs")
+    convert.add_argument('--input', default=OSM_PATH)
+    convert.add_argument('--streets-from', default=SAMPLE_FILE,
+                         help="osm file whose street names name_street_fix compares with")
+    convert.add_argument('--no-validate', dest='validate', action='store_false',
+                         help="skip schema validation, which is ~ 10X slower")
+    mode = convert.add_mutually_exclusive_group()
+    mode.add_argument('--resume', action='store_true', help="continue from the last checkpoint")
+    mode.add_argument('--pipelined', action='store_true', help="parse, shape and write concurrently")
+    mode.add_argument('--encoded', action='store_true', help="write dictionary encoded csvs")
+    mode.add_argument('--partitioned', action='store_true', help="write the csvs once for each tile")
+    convert.add_argument('--workers', type=int, help="shaping processes for --pipelined")
+    convert.add_argument('--tile-size', type=float, default=TILE_SIZE, help="tile size in degrees for --partitioned")
+    convert.add_argument('--partition-dir', default=PARTITION_DIR)
+    convert.add_argument('--snapshot', help="save data quality metrics for this conversion under this name")
+    convert.add_argument('--metrics-db', default=METRICS_DB_PATH)
+
+    load = commands.add_parser('load', help="load the csvs into the database")
+    load.add_argument('--db', default=DB_PATH)
+    load.add_argument('--encoded', action='store_true', help="load the dictionary encoded csvs written by convert --encoded")
+
+    report_parser = commands.add_parser('report', help="print the report queries")
+    report_parser.add_argument('--db', default=DB_PATH)
+    report_parser.add_argument('--format', choices=['print', 'json', 'csv'], default='print')
+    report_parser.add_argument('--output', help="JSON file or csv directory to write to")
+    report_parser.add_argument('--workers', type=int, default=REPORT_WORKERS)
+
+    diff = commands.add_parser('diff', help="write the differences between two osm extracts")
+    diff.add_argument('old', help="the earlier extract")
+    diff.add_argument('new', help="the later extract")
+    diff.add_argument('--output', default=DIFF_PATH)
+    diff.add_argument('--osc', help="also write the changes to this osmChange file")
+
+    check = commands.add_parser('check', help="check that every way node ref is to a node")
+    check.add_argument('--input', default=OSM_PATH, help="osm file to check, with its nodes before its ways")
+    check.add_argument('--csv', action='store_true', help="check nodes.csv and ways_nodes.csv instead")
+
+    graph = commands.add_parser('graph', help="write the road network as a memory mappable graph")
+    graph.add_argument('--input', default=OSM_PATH)
+    graph.add_argument('--output', default=GRAPH_PATH)
+
+    geojson = commands.add_parser('geojson', help="write the cleaned nodes and ways as newline delimited GeoJSON")
+    geojson.add_argument('--input', default=OSM_PATH)
+    geojson.add_argument('--output', default=GEOJSON_PATH)
+    geojson.add_argument('--filter', action='append', metavar='KEY[=VALUE]',
+                         help="only export features with this tag, may be given more than once")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'sample':
+        make_sample(args.input, args.output, args.k)
+        print "First ten elements of the sample file:"
+        print_first_elements(args.output)
+        print "Node tags:"
+        print_node_tags(args.output)
+    elif args.command == 'audit':
+        audit(args.input, args.users_input)
+    elif args.command == 'convert':
+        if os.path.exists(args.streets_from):
+            load_street_values(args.streets_from)
+        # Note: Validation is ~ 10X slower. For the project consider using a small
+        # sample of the map when validating.
+        if args.snapshot and (args.pipelined or args.encoded or args.partitioned):
+            parser.error("--snapshot is only supported by the default conversion")
+        if args.pipelined:
+            process_map_pipelined(args.input, args.validate, workers=args.workers)
+        elif args.encoded:
+            process_map_encoded(args.input, args.validate)
+        elif args.partitioned:
+            process_map_partitioned(args.input, args.validate, args.partition_dir, args.tile_size)
+        elif args.snapshot:
+            metrics = QualityMetrics()
+            process_map(args.input, args.validate, resume=args.resume, metrics=metrics)
+            save_metrics(metrics, args.snapshot, args.input, args.metrics_db)
+        else:
+            process_map(args.input, args.validate, resume=args.resume)
+    elif args.command == 'load':
+        if args.encoded:
+            load_encoded_database(args.db)
+        else:
+            load_database(args.db)
+    elif args.command == 'report':
+        report(args.db, args.format, args.output, args.workers)
+    elif args.command == 'diff':
+        counts = write_diff(args.old, args.new, args.output, args.osc)
+        for (action, tag), n in sorted(counts.iteritems()):
+            print "{0} {1}s: {2}".format(action, tag, n)
+    elif args.command == 'check':
+        if args.csv:
+            counts = check_csv_references()
+        else:
+            counts = check_references(args.input)
+        print "{nodes} nodes, {referenced} used by ways, {unused} unused".format(**counts)
+        print "{dangling} way node refs to missing nodes".format(**counts)
+    elif args.command == 'graph':
+        counts = build_road_graph(args.input, args.output)
+        print "{vertices} vertices, {edges} edges".format(**counts)
+    elif args.command == 'geojson':
+        counts = export_geojson(args.input, args.output, args.filter)
+        print "{0} nodes, {1} ways".format(counts['node'], counts['way'])
+
+
+if __name__ == '__main__':
+    main()